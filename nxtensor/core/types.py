@@ -24,5 +24,8 @@ MetaDataBlock = NewType('MetaDataBlock', Sequence[Mapping[Union[TimeResolution,
 # TimeResolution::TIME_RESOLUTION_KEYS (same order).
 Period = NewType('Period', Tuple[Union[float, int], ...])
 
+# A Period packed into an integer (see time_utils.pack_period).
+PeriodCode = int
+
 
 DBMetadataMapping = Dict[Union[Coordinate, TimeResolution], str]
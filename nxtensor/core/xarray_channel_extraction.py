@@ -7,7 +7,7 @@ Created on Wed Apr  22 09:20:10 2020
 """
 
 from abc import abstractmethod, ABC
-from typing import Dict, Set, Tuple, Mapping, Sequence, List
+from typing import Callable, Dict, Tuple, Mapping, List, Sequence
 
 import pandas as pd
 import xarray as xr
@@ -20,8 +20,10 @@ from nxtensor.utils.tensor_dimensions import TensorDimension
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.db_utils import create_db_metadata_mapping
 from nxtensor.utils.csv_option_names import CsvOptName
+from nxtensor.utils.hdf5_formats import HDF5Format
 
-from multiprocessing import Pool
+from multiprocessing import get_all_start_methods, get_context
+from concurrent.futures import ThreadPoolExecutor
 import os.path as path
 import os
 
@@ -32,14 +34,19 @@ import nxtensor.utils.db_utils as du
 
 import pickle
 
+import functools
+
 import time
 
-from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period, DBMetadataMapping
+from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period, PeriodCode, DBMetadataMapping
 
 import numpy as np
 
 INDEX_NAME = 'index'
 
+# Maximum number of threads that write the files of a period (see __core_extraction).
+MAX_WRITE_THREADS: int = 8
+
 
 METADATA_TYPES = {TimeResolution.DAY: np.int8, TimeResolution.DAY2D: np.str,
                   TimeResolution.HOUR: np.int8, TimeResolution.HOUR2D: np.str,
@@ -58,31 +65,44 @@ class BlockProcessor(ABC):
 
 
 def convert_block_to_dict(extraction_metadata_block: pd.DataFrame) -> MetaDataBlock:
-    result = extraction_metadata_block.to_dict('records')
-    for dictionary in result:
-        dictionary[TimeResolution.MONTH2D] = f"{int(dictionary[TimeResolution.MONTH]):02d}"
-        dictionary[TimeResolution.DAY2D] = f"{int(dictionary[TimeResolution.DAY]):02d}"
-        dictionary[TimeResolution.HOUR2D] = f"{int(dictionary[TimeResolution.HOUR]):02d}"
+    # Build the records from the columns (structure of arrays to array of structures).
+    # The two digit columns are computed once per column (numpy string kernels), not row by row,
+    # and tolist converts the values of a column into python objects in one call.
+    keys = (*extraction_metadata_block.columns, TimeResolution.MONTH2D, TimeResolution.DAY2D, TimeResolution.HOUR2D)
+    columns = [column.to_numpy().tolist() for _, column in extraction_metadata_block.items()]
+    for time_key in (TimeResolution.MONTH, TimeResolution.DAY, TimeResolution.HOUR):
+        columns.append(__to_two_digits(extraction_metadata_block[time_key]).tolist())
+    result = [dict(zip(keys, row)) for row in zip(*columns)]
     return result
 
 
+# Return the values of the given column as zero-padded strings of two digits (e.g. 1 -> '01').
+def __to_two_digits(column: pd.Series) -> np.ndarray:
+    return np.char.zfill(column.to_numpy(dtype=np.int64).astype(str), 2)
+
+
 def preprocess_extraction(preprocessing_output_file_path: str,
                           extraction_metadata_blocks: Mapping[LabelId, pd.DataFrame],
                           db_metadata_mappings: Mapping[LabelId, DBMetadataMapping],
                           netcdf_file_time_period: TimeResolution,
                           label_num_ids: Mapping[str, float],
                           inplace: bool = False):
+    # The time keys of the periods are the same for all the labels.
+    period_keys = __compute_period_keys(netcdf_file_time_period)
     # Compute the extraction_metadata_blocks according to the label for all the period of time.
+    # The periods are packed into codes until the merge of the structures.
+    period_codes: Dict[PeriodCode, Period] = dict()
     structures = dict()
     for label_id, dataframe in extraction_metadata_blocks.items():
         db_metadata_mapping = db_metadata_mappings[label_id]
         label_num_id = label_num_ids[label_id]
-        structure = \
-            __build_blocks_structure(dataframe, db_metadata_mapping, netcdf_file_time_period, label_num_id, inplace)
+        structure = __build_blocks_structure(dataframe, db_metadata_mapping, period_keys, label_num_id,
+                                             period_codes, inplace)
         structures[label_id] = structure
 
     # Merged_structures guarantees the order (following period, label_id and extraction metadata).
-    merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = __merge_block_structures(structures)
+    merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = \
+        __merge_block_structures(structures, period_codes)
     del structures
 
     os.makedirs(path.dirname(preprocessing_output_file_path), exist_ok=True)
@@ -98,9 +118,13 @@ def extract(variable_id: str,
             preprocess_input_file_path: str,
             block_processor: BlockProcessor,
             extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None,
-            nb_workers: int = 1) -> Dict[Period, Dict[str, Dict[str, str]]]:
-
+            nb_workers: int = 1,
+            data_block_hdf5_format: HDF5Format = HDF5Format.COMPRESSED,
+            use_pyarrow_csv_writer: bool = False) -> Dict[Period, Dict[str, Dict[str, str]]]:
     # Returns the extraction data and extraction metadata blocks file paths.
+    # use_pyarrow_csv_writer: see csv_utils.to_csv (the floats are not formatted as the csv module does).
+    # HDF5Format.TABLE is meant for the pipelines that don't require raw numpy dumps
+    # (the data blocks of any format are read with hdf5_utils.read_ndarray_from_hdf5).
     try:
         with open(preprocess_input_file_path, 'rb') as file:
             merged_structures = pickle.load(file=file)
@@ -108,89 +132,190 @@ def extract(variable_id: str,
         msg = f'unable to load extraction preprocessing located at {preprocess_input_file_path}'
         raise Exception(msg, e)
 
-    static_parameters = (variable_id, block_processor,
-                         extraction_metadata_block_csv_save_options)
-    parameters_list = [(period, extraction_metadata_blocks, *static_parameters)
-                       for period, extraction_metadata_blocks in merged_structures]
+    # The static parameters are shipped once per worker process rather than once per period.
+    data_block_write_function = nxtensor.utils.hdf5_utils.get_ndarray_write_function(data_block_hdf5_format)
+    # The write threads of all the worker processes share the CPUs (see __core_extraction).
+    nb_write_threads = max(1, min(MAX_WRITE_THREADS, (os.cpu_count() or 1) // max(1, nb_workers)))
+    static_parameters = (variable_id, block_processor, extraction_metadata_block_csv_save_options,
+                         data_block_write_function, use_pyarrow_csv_writer, nb_write_threads)
+    # The extraction metadata blocks are inherited by the forked worker processes (copy-on-write), or shipped once
+    # per worker process when fork is not available: only the index of a period is pickled per task.
+    global __worker_merged_structures
+    __worker_merged_structures = merged_structures
     start = time.time()
-    if nb_workers > 1:
-        print(f"> variable {variable_id} starting parallel extractions (number of workers: {nb_workers})")
-        with Pool(processes=nb_workers) as pool:
-            tmp_result = pool.map(func=__map_core_extraction, iterable=parameters_list, chunksize=1)
-    else:
-        print(f"> variable {variable_id} starting sequential extractions")
-        tmp_result = list()
-        for parameters in parameters_list:
-            tmp_result.append(__map_core_extraction(parameters))
+    try:
+        if nb_workers > 1:
+            print(f"> variable {variable_id} starting parallel extractions (number of workers: {nb_workers})")
+            # Batch the periods so as to amortize the dispatch, while keeping 4 batches per worker
+            # to balance the load between the workers.
+            chunksize = max(1, len(merged_structures) // (nb_workers * 4))
+            if 'fork' in get_all_start_methods():
+                # The workers inherit __worker_merged_structures.
+                context = get_context('fork')
+                initargs = (None, *static_parameters)
+            else:
+                context = get_context()
+                initargs = (merged_structures, *static_parameters)
+            with context.Pool(processes=nb_workers, initializer=__init_worker, initargs=initargs) as pool:
+                # Stream the results into the dict as soon as they are computed (in any order).
+                result = dict(pool.imap_unordered(func=__map_core_extraction, iterable=range(len(merged_structures)),
+                                                  chunksize=chunksize))
+        else:
+            print(f"> variable {variable_id} starting sequential extractions")
+            __init_worker(None, *static_parameters)
+            result = dict(__map_core_extraction(index) for index in range(len(merged_structures)))
+    finally:
+        # The sequential extractions set the worker parameters in this process: release them.
+        __reset_worker()
     print(f"> elapsed time: {tu.display_duration(time.time()-start)}")
-    result = dict(tmp_result)
     return result
 
 
-def __map_core_extraction(parameters):
-    return __core_extraction(*parameters)
+# Extraction metadata blocks, set by extract before forking the worker processes (or by __init_worker).
+__worker_merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = None
+
+# Static parameters of the extraction, set by __init_worker in each worker process.
+__worker_variable_id: VariableId = None
+__worker_block_processor: BlockProcessor = None
+__worker_csv_save_options: Mapping[CsvOptName, any] = None
+__worker_data_block_write_function: Callable[[str, np.ndarray], None] = None
+__worker_use_pyarrow_csv_writer: bool = False
+__worker_nb_write_threads: int = 1
+
+
+# merged_structures: None when the worker inherits __worker_merged_structures (fork).
+def __init_worker(merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]],
+                  variable_id: VariableId, block_processor: BlockProcessor,
+                  extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any],
+                  data_block_write_function: Callable[[str, np.ndarray], None],
+                  use_pyarrow_csv_writer: bool, nb_write_threads: int) -> None:
+    global __worker_merged_structures, __worker_variable_id, __worker_block_processor, __worker_csv_save_options, \
+        __worker_data_block_write_function, __worker_use_pyarrow_csv_writer, __worker_nb_write_threads
+    if merged_structures is not None:
+        __worker_merged_structures = merged_structures
+    __worker_variable_id = variable_id
+    __worker_block_processor = block_processor
+    __worker_csv_save_options = extraction_metadata_block_csv_save_options
+    __worker_data_block_write_function = data_block_write_function
+    __worker_use_pyarrow_csv_writer = use_pyarrow_csv_writer
+    __worker_nb_write_threads = nb_write_threads
+
+
+def __reset_worker() -> None:
+    global __worker_merged_structures, __worker_variable_id, __worker_block_processor, __worker_csv_save_options, \
+        __worker_data_block_write_function, __worker_use_pyarrow_csv_writer, __worker_nb_write_threads
+    __worker_merged_structures = None
+    __worker_variable_id = None
+    __worker_block_processor = None
+    __worker_csv_save_options = None
+    __worker_data_block_write_function = None
+    __worker_use_pyarrow_csv_writer = False
+    __worker_nb_write_threads = 1
+
+
+def __map_core_extraction(index: int) -> Tuple[Period, Dict[str, Dict[str, str]]]:
+    period, extraction_metadata_blocks = __worker_merged_structures[index]
+    return __core_extraction(period, extraction_metadata_blocks, __worker_variable_id, __worker_block_processor,
+                             __worker_csv_save_options, __worker_data_block_write_function,
+                             __worker_use_pyarrow_csv_writer, __worker_nb_write_threads)
 
 
 def __core_extraction(period: Period,
                       extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
                       variable_id: VariableId,
                       block_processor: BlockProcessor,
-                      extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None)\
+                      extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None,
+                      data_block_write_function: Callable[[str, np.ndarray], None] =
+                      nxtensor.utils.hdf5_utils.write_compressed_ndarray_to_hdf5,
+                      use_pyarrow_csv_writer: bool = False,
+                      nb_write_threads: int = 1)\
                       -> Tuple[Period, Dict[str, Dict[str, str]]]:
     result: Dict[str, Dict[str, str]] = dict()
     parent_dir_path, extracted_data_blocks = block_processor.process_blocks(period, extraction_metadata_blocks)
 
+    # The period directory is the same for all the labels: create it only once.
+    period_str = nu.create_period_str(period)
+    period_dir_path = path.join(parent_dir_path, period_str)
+    os.makedirs(period_dir_path, exist_ok=True)
+
+    writes: List[Callable[[], None]] = list()
     for extracted_data_block in extracted_data_blocks:
         label_id, data_block, metadata_block = extracted_data_block
-        period_str = nu.create_period_str(period)
-        data_metadata_parent_dir = path.join(parent_dir_path, f"{period_str}", label_id)
+        data_metadata_parent_dir = path.join(period_dir_path, label_id)
         os.makedirs(data_metadata_parent_dir, exist_ok=True)
         data_block_file_path, metadata_block_file_path = \
             nu.compute_data_meta_data_file_path(variable_id, data_metadata_parent_dir)
         if extraction_metadata_block_csv_save_options is None:
-            cu.to_csv(data=metadata_block, file_path=metadata_block_file_path)
+            writes.append(functools.partial(cu.to_csv, data=metadata_block, file_path=metadata_block_file_path,
+                                            use_pyarrow=use_pyarrow_csv_writer))
         else:
-            cu.to_csv(data=metadata_block, file_path=metadata_block_file_path,
-                      csv_options=extraction_metadata_block_csv_save_options)
+            writes.append(functools.partial(cu.to_csv, data=metadata_block, file_path=metadata_block_file_path,
+                                            csv_options=extraction_metadata_block_csv_save_options,
+                                            use_pyarrow=use_pyarrow_csv_writer))
 
-        nxtensor.utils.hdf5_utils.write_ndarray_to_hdf5(data_block_file_path, data_block.values)
-        print(f'> saved {label_id} data block (shape: {data_block.shape}) for period {period_str}')
+        writes.append(functools.partial(data_block_write_function, data_block_file_path, data_block.values))
         result[label_id] = dict()
         result[label_id]['data_block'] = data_block_file_path
         result[label_id]['metadata_block'] = metadata_block_file_path
+
+    # The csv and hdf5 files are independent, but the threads mostly serialize: h5py holds a global lock around
+    # every call (compression included) and the csv module writer is pure python. Only the file system I/O of the
+    # csv files overlaps the hdf5 writes.
+    if nb_write_threads > 1 and len(writes) > 1:
+        with ThreadPoolExecutor(max_workers=min(nb_write_threads, len(writes))) as executor:
+            futures = [executor.submit(write) for write in writes]
+            # Raise the exception of the writes, if any.
+            for future in futures:
+                future.result()
+    else:
+        for write in writes:
+            write()
+
+    for label_id, data_block, _ in extracted_data_blocks:
+        print(f'> saved {label_id} data block (shape: {data_block.shape}) for period {period_str}')
     return period, result
 
 
 # Enable processing of extractions period by period so as to open a netcdf file only one time.
 # The returned data structure is ordered following the Period and the LabelId.
-def __merge_block_structures(structures: Mapping[LabelId, Dict[Period, MetaDataBlock]])\
+# The structures are keyed by period codes, translated back into periods thanks to period_codes.
+def __merge_block_structures(structures: Mapping[LabelId, Dict[PeriodCode, MetaDataBlock]],
+                             period_codes: Mapping[PeriodCode, Period])\
         -> List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]]:
     # str for label_id.
-    # Build a set of periods.
-    # (like (year, month), e.g. (2000, 10)).
-    periods: Set[Period] = set()
-    for structure in structures.values():
-        periods.update(structure.keys())
+    # Visit each (label, period) entry only once, following the order of the labels.
+    # (periods like (year, month), e.g. (2000, 10)).
+    merged_blocks: Dict[PeriodCode, List[Tuple[LabelId, MetaDataBlock]]] = dict()
+    for label_id in nu.sort_labels(structures.keys()):
+        for period_code, block in structures[label_id].items():
+            merged_blocks.setdefault(period_code, list()).append((label_id, block))
 
-    periods: Sequence[Period] = tu.sort_periods(periods)
-    label_ids = nu.sort_labels(structures.keys())
+    # The period codes are sorted as the periods.
+    result: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = \
+        [(period_codes[period_code], merged_blocks[period_code]) for period_code in sorted(merged_blocks.keys())]
 
-    result: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = list()
+    return result
 
-    for period in periods:
-        current_blocks: List[Tuple[LabelId, MetaDataBlock]] = list()
-        for label_id in label_ids:
-            if period in structures[label_id]:
-                current_blocks.append((label_id, structures[label_id][period]))
-        result.append((period, current_blocks))
 
-    return result
+# Return the time keys of the period covered by the netcdf file
+# (e.g. (year, month) for a netcdf file that covers a month of data).
+@functools.lru_cache(maxsize=None)
+def __compute_period_keys(netcdf_file_time_period: TimeResolution) -> Sequence[TimeResolution]:
+    try:
+        resolution_degree = TimeResolution.KEYS.index(netcdf_file_time_period)
+    except ValueError as e:
+        msg = f"'{netcdf_file_time_period}' is not a known time resolution"
+        raise ConfigurationError(msg, e)
+    return TimeResolution.KEYS[0:(resolution_degree + 1)]
 
 
 def __build_blocks_structure(dataframe: pd.DataFrame, db_metadata_mapping: DBMetadataMapping,
-                             netcdf_file_time_period: TimeResolution, label_num_id: float,
-                             inplace=False) -> Dict[Period, MetaDataBlock]:
+                             period_keys: Sequence[TimeResolution], label_num_id: float,
+                             period_codes: Dict[PeriodCode, Period], inplace=False) -> Dict[PeriodCode, MetaDataBlock]:
     # Return the dataframe grouped by the given period covered by the netcdf file.
+    # The period is described by period_keys (see __compute_period_keys).
+    # The periods are packed into codes (see time_utils.pack_period) and period_codes is updated
+    # with the mapping code -> period.
     # The result is a dictionary of extraction_metadata_blocks (rows of the given dataframe) mapped with a
     # period (a tuple of time attributes).
     # It also renames (inplace or not) the name of the columns of the dataframe, according
@@ -208,18 +333,12 @@ def __build_blocks_structure(dataframe: pd.DataFrame, db_metadata_mapping: DBMet
     #     - dataframe row at index 7
     #     ...
     #  ...
-    try:
-        resolution_degree = TimeResolution.KEYS.index(netcdf_file_time_period)
-    except ValueError as e:
-        msg = f"'{netcdf_file_time_period}' is not a known time resolution"
-        raise ConfigurationError(msg, e)
 
     # Add the numerical id of the label.
     dataframe[TensorDimension.LABEL_NUM_ID] = label_num_id
 
-    list_keys = TimeResolution.KEYS[0:(resolution_degree + 1)]
-    list_column_names = [db_metadata_mapping[key] for key in list_keys]
-    indices = dataframe.groupby(list_column_names).indices
+    list_column_names = [db_metadata_mapping[key] for key in period_keys]
+    indices = __group_by_period(dataframe, list_column_names)
 
     # Rename the columns of the dataframe.
     reverse_metadata_mapping = {v: k for k, v in db_metadata_mapping.items()}
@@ -227,28 +346,71 @@ def __build_blocks_structure(dataframe: pd.DataFrame, db_metadata_mapping: DBMet
         dataframe.rename(reverse_metadata_mapping, axis='columns', inplace=True)
         renamed_df = dataframe
     else:
-        renamed_df = dataframe.rename(reverse_metadata_mapping, axis='columns', inplace=False)
+        # Shallow copy: only the column labels are new, the data of the columns is not copied.
+        renamed_df = dataframe.copy(deep=False)
+        renamed_df.columns = [reverse_metadata_mapping.get(column_name, column_name)
+                              for column_name in dataframe.columns]
 
-    renamed_df.index.name = INDEX_NAME
+    # Don't modify the index of the given dataframe when it is shared (not inplace).
+    renamed_df.index = renamed_df.index.rename(INDEX_NAME)
     # Select only the columns of interest (lat, lon, year, etc.).
     selected_columns = list(db_metadata_mapping.keys())
     selected_columns.append(TensorDimension.LABEL_NUM_ID)
-    restricted_renamed_df = renamed_df[selected_columns]
 
     # Compute the extraction_metadata_blocks.
-    result: Dict[Period, MetaDataBlock] = dict()
-    for index, value in indices.items():
-        result[index] = convert_block_to_dict(restricted_renamed_df.loc[value])
+    # The columns of interest are extracted once as numpy arrays (views, no copy) then sliced by the positions
+    # of each group (avoid the label based indexer of pandas and preserve the dtype of each column).
+    column_arrays = {column_name: renamed_df[column_name].to_numpy() for column_name in selected_columns}
+    result: Dict[PeriodCode, MetaDataBlock] = dict()
+    for period, positions in indices.items():
+        block = pd.DataFrame({column_name: array[positions] for column_name, array in column_arrays.items()},
+                             copy=False)
+        period_code = tu.pack_period(period)
+        period_codes[period_code] = period
+        result[period_code] = convert_block_to_dict(block)
 
     return result
 
 
-def __test_build_blocks_structure(csv_file_path: str, period_resolution: TimeResolution, label_num_id: float)\
-        -> Dict[Period, MetaDataBlock]:
+# Return the positions of the rows of the dataframe, grouped by period.
+# The time columns are packed into a single int64 key (each column is offset by its minimum value
+# and takes as many bits as its range of values needs): hashing int64 is much faster than hashing tuples.
+# The keys are mapped back to their periods afterwards.
+def __group_by_period(dataframe: pd.DataFrame, list_column_names: List[str]) -> Dict[Period, np.ndarray]:
+    if len(dataframe) == 0:
+        return dict()
+
+    time_columns = [dataframe[column_name].to_numpy(dtype=np.int64) for column_name in list_column_names]
+    keys = np.zeros(len(dataframe), dtype=np.int64)
+    total_nb_bits = 0
+    for time_column in time_columns:
+        min_value = time_column.min()
+        nb_bits = int(time_column.max() - min_value).bit_length()
+        total_nb_bits += nb_bits
+        keys = (keys << nb_bits) | (time_column - min_value)
+
+    if total_nb_bits > 63:  # Doesn't fit into an int64.
+        return {tuple(period) if isinstance(period, tuple) else (period,): positions
+                for period, positions in dataframe.groupby(list_column_names).indices.items()}
+
+    # The narrower the keys, the faster the hashing (fewer bytes read).
+    keys = keys.astype(np.min_scalar_type((1 << total_nb_bits) - 1), copy=False)
+    result: Dict[Period, np.ndarray] = dict()
+    for positions in pd.Series(keys).groupby(keys).indices.values():
+        first_position = positions[0]
+        # noinspection PyTypeChecker
+        period: Period = tuple(int(time_column[first_position]) for time_column in time_columns)
+        result[period] = positions
+    return result
+
+
+def __test_build_blocks_structure(csv_file_path: str, period_resolution: TimeResolution, label_num_id: float,
+                                  period_codes: Dict[PeriodCode, Period]) -> Dict[PeriodCode, MetaDataBlock]:
     dataframe = du.load_csv_file(csv_file_path)
     db_metadata_mapping = create_db_metadata_mapping(year='year', month='month', day='day', hour='hour',
                                                      lat='lat', lon='lon')
-    return __build_blocks_structure(dataframe, db_metadata_mapping, period_resolution, label_num_id, True)
+    return __build_blocks_structure(dataframe, db_metadata_mapping, __compute_period_keys(period_resolution),
+                                    label_num_id, period_codes, True)
 
 
 def __test__merge_block_structures():
@@ -256,11 +418,14 @@ def __test__merge_block_structures():
     no_cyclone_csv_file_path = '/data/sgardoll/cyclone_data/dataset/2000_10_no_cyclone_dataset.csv'
     period_resolution = TimeResolution.MONTH
 
+    period_codes = dict()
     structures = dict()
-    structures['cyclone'] = __test_build_blocks_structure(cyclone_csv_file_path, period_resolution, 1.)
-    structures['no_cyclone'] = __test_build_blocks_structure(no_cyclone_csv_file_path, period_resolution, 0.)
+    structures['cyclone'] = __test_build_blocks_structure(cyclone_csv_file_path, period_resolution, 1., period_codes)
+    structures['no_cyclone'] = __test_build_blocks_structure(no_cyclone_csv_file_path, period_resolution, 0.,
+                                                             period_codes)
 
-    merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = __merge_block_structures(structures)
+    merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = \
+        __merge_block_structures(structures, period_codes)
     period1 = merged_structures[0][0]
     period2 = merged_structures[1][0]
 
@@ -279,7 +444,27 @@ def __test__merge_block_structures():
     assert len(merged_structures[0][1]) == 1  # Cyclone not in period (2000, 9).
 
 
+# The grouping on the bit-packed keys must match the grouping of pandas (the grouping it replaces), for the keys
+# that fit into an int64 as for the others.
+def __test_group_by_period():
+    rng = np.random.default_rng(0)
+    nb_rows = 1000
+    dataframe = pd.DataFrame({'year': rng.integers(1979, 2020, nb_rows), 'month': rng.integers(1, 13, nb_rows),
+                              'day': rng.integers(1, 32, nb_rows), 'hour': rng.integers(0, 24, nb_rows),
+                              'huge': rng.integers(0, 2**40, nb_rows)})
+    for list_column_names in (['year'], ['year', 'month'], ['year', 'month', 'day', 'hour'],
+                              ['year', 'huge', 'huge']):
+        result = __group_by_period(dataframe, list_column_names)
+        expected_result = {period if isinstance(period, tuple) else (period,): positions
+                           for period, positions in dataframe.groupby(list_column_names).indices.items()}
+        assert result.keys() == expected_result.keys()
+        for period, positions in expected_result.items():
+            assert np.array_equal(result[period], positions)
+    assert __group_by_period(dataframe.iloc[0:0], ['year']) == dict()
+
+
 def __all_tests():
+    __test_group_by_period()
     __test__merge_block_structures()
 
 
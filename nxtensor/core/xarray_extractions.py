@@ -5,25 +5,163 @@ Created on Fri Apr 17 10:50:00 2020
 
 @author: sebastien@gardoll.fr
 """
-from typing import Mapping
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import functools
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Set, Tuple, Sequence, Union
+import weakref
 
 import dask
+import netCDF4
+import numpy as np
+import pandas as pd
 import xarray as xr
 import nxtensor.utils.coordinate_utils as coordinate_utils
 from nxtensor.exceptions import ExtractionError
+from nxtensor.utils.netcdf_backends import NetcdfBackend
 
 # Ignore 'DataArray.py:1965: FutureWarning: dropping coordinates using `drop` is be deprecated; use drop_vars'
 import warnings
 warnings.filterwarnings('ignore')
 
 
-def open_netcdf(netcdf_file_path: str, options: Mapping[str, str] = None) -> xr.Dataset:
+# Maximum number of netcdf files kept open by open_netcdf (see configure_netcdf_cache).
+NETCDF_CACHE_SIZE: int = 8
+
+# Open the files in parallel (dask delayed), keep the chunks of the files and skip the cross-file comparisons
+# of the variables and coordinates (the files of a variable share the same metadata).
+OPEN_MFDATASET_DEFAULT_OPTIONS: Mapping[str, any] = {'parallel': True, 'chunks': {}, 'combine': 'by_coords',
+                                                     'data_vars': 'minimal', 'coords': 'minimal',
+                                                     'compat': 'override'}
+
+# Default number of batches of regions computed ahead by compute_square_regions_stream.
+PREFETCH_LOOKAHEAD: int = 2
+
+# Options of xarray.open_dataset for a single netcdf file. The times are not decoded when the file is opened:
+# only the time coordinate is decoded, on the first extraction (see __get_index). The scale factors and the missing
+# values of the variables are still applied.
+OPEN_DATASET_DEFAULT_OPTIONS: Mapping[str, any] = {'decode_times': False, 'decode_coords': False}
+
+# Dataset opened by open_netcdf, depending on the backend (see NetcdfBackend).
+NetcdfDataset = Union[xr.Dataset, netCDF4.Dataset]
+
+# LRU cache of the opened netcdf files, so as to read the header of a netcdf file only once
+# across the extractions. The key is the file paths, the open options and the backend. The value is the dataset
+# and its number of users (the calls of open_netcdf not released by close_netcdf yet): a dataset in use is not
+# closed when it is evicted from the cache.
+__NETCDF_CACHE: 'OrderedDict[Tuple[Tuple[str, ...], str, bool, str], List[Union[NetcdfDataset, int]]]' = \
+    OrderedDict()
+
+
+# Open one netcdf file or several netcdf files as one dataset, concatenated along the time dimension.
+# use_dask: for several files, use xarray.open_mfdataset (dask arrays). Otherwise, the files are opened one
+# by one without dask and concatenated without cross-file comparisons (the extractions only slice small regions:
+# the building of dask graphs costs more than it saves). Beware: the concatenation loads the files in memory.
+# backend: NetcdfBackend.NETCDF4 opens a netCDF4 dataset (netCDF4.MFDataset for several files, which only
+# supports the NETCDF3 and NETCDF4_CLASSIC formats): the options, use_dask and engine are ignored.
+# engine: the xarray engine (e.g. 'netcdf4', 'h5netcdf'), the default engine of xarray when None.
+# The returned dataset is shared by the cache: release it with close_netcdf, not with dataset.close().
+def open_netcdf(netcdf_file_path: Union[str, Sequence[str]], options: Mapping[str, str] = None,
+                use_dask: bool = False, time_netcdf_attr_name: str = 'time',
+                backend: NetcdfBackend = NetcdfBackend.XARRAY, engine: str = None) -> NetcdfDataset:
     if options is None:
         options = {}
-    return xr.open_dataset(netcdf_file_path, **options)
+    if engine is not None:
+        options = {**options, 'engine': engine}
+    netcdf_file_paths = (netcdf_file_path,) if isinstance(netcdf_file_path, str) else tuple(netcdf_file_path)
+    # repr because the values of the options may not be hashable (e.g. chunks).
+    key = (netcdf_file_paths, repr(sorted(options.items())), use_dask, backend)
+    entry = __NETCDF_CACHE.get(key, None)
+    if entry is None:
+        if backend == NetcdfBackend.XARRAY:
+            dataset = __open_netcdf_files(netcdf_file_paths, options, use_dask, time_netcdf_attr_name)
+        elif backend == NetcdfBackend.NETCDF4:
+            dataset = __open_netcdf4_files(netcdf_file_paths, time_netcdf_attr_name)
+        else:
+            msg = f"unsupported netcdf backend '{backend}'"
+            raise ExtractionError(msg)
+        entry = [dataset, 0]
+        __NETCDF_CACHE[key] = entry
+    else:
+        __NETCDF_CACHE.move_to_end(key)
+    entry[1] = entry[1] + 1
+    __evict_netcdf_files()
+    return entry[0]
+
+
+# Close the least recently used datasets that are not in use, until the cache fits NETCDF_CACHE_SIZE
+# (the cache exceeds NETCDF_CACHE_SIZE while more datasets are in use).
+def __evict_netcdf_files() -> None:
+    nb_evictions = len(__NETCDF_CACHE) - NETCDF_CACHE_SIZE
+    if nb_evictions > 0:
+        evicted_keys = [key for key, (_, nb_users) in __NETCDF_CACHE.items() if nb_users == 0][:nb_evictions]
+        for key in evicted_keys:
+            dataset, _ = __NETCDF_CACHE.pop(key)
+            dataset.close()
+
+
+def __open_netcdf_files(netcdf_file_paths: Sequence[str], options: Mapping[str, str], use_dask: bool,
+                        time_netcdf_attr_name: str) -> xr.Dataset:
+    if len(netcdf_file_paths) == 1:
+        # The given options override the default ones.
+        return xr.open_dataset(netcdf_file_paths[0], **{**OPEN_DATASET_DEFAULT_OPTIONS, **options})
+    # The times of several files are decoded: their units may differ.
+    if use_dask:
+        # The given options override the default ones.
+        return xr.open_mfdataset(netcdf_file_paths, **{**OPEN_MFDATASET_DEFAULT_OPTIONS, **options})
+    datasets = [xr.open_dataset(netcdf_file_path, **options) for netcdf_file_path in netcdf_file_paths]
+    result = xr.concat(datasets, dim=time_netcdf_attr_name, data_vars='minimal', coords='minimal',
+                       compat='override')
+    # Closing the concatenation closes the files.
+    result.set_close(lambda: [dataset.close() for dataset in datasets])
+    return result
+
+
+def __open_netcdf4_files(netcdf_file_paths: Sequence[str], time_netcdf_attr_name: str) -> netCDF4.Dataset:
+    if len(netcdf_file_paths) == 1:
+        return netCDF4.Dataset(netcdf_file_paths[0], 'r')
+    else:
+        return netCDF4.MFDataset(netcdf_file_paths, aggdim=time_netcdf_attr_name)
+
+
+# Release the given dataset. A dataset opened by open_netcdf is only closed when it is no longer in use and
+# evicted from the cache. The other datasets are closed.
+def close_netcdf(dataset: NetcdfDataset) -> None:
+    for entry in __NETCDF_CACHE.values():
+        if entry[0] is dataset:
+            if entry[1] < 1:
+                msg = 'the dataset is already released'
+                raise ExtractionError(msg)
+            entry[1] = entry[1] - 1
+            __evict_netcdf_files()
+            return
+    dataset.close()
+
+
+# Set the maximum number of netcdf files (datasets) kept open by open_netcdf. The datasets in excess are closed
+# when they are not in use. The file cache of xarray (file_cache_maxsize option) is enlarged if needed, so as
+# xarray does not close (then reopen) the files of the datasets kept open.
+def configure_netcdf_cache(cache_size: int) -> None:
+    if cache_size < 1:
+        msg = f"the size of the netcdf cache must be positive (got {cache_size})"
+        raise ExtractionError(msg)
+    global NETCDF_CACHE_SIZE
+    NETCDF_CACHE_SIZE = cache_size
+    if xr.get_options()['file_cache_maxsize'] < cache_size:
+        xr.set_options(file_cache_maxsize=cache_size)
+    __evict_netcdf_files()
+
+
+# Close all the netcdf files kept open by open_netcdf, even the ones in use.
+def clear_netcdf_cache() -> None:
+    while __NETCDF_CACHE:
+        _, (dataset, _) = __NETCDF_CACHE.popitem(last=False)
+        dataset.close()
 
 
 # Extract the region that centers the given lat/lon location.
+# dtype: the dtype of the returned region (e.g. np.float32), the dtype of the netcdf variable when None.
 def extract_square_region(dataset: xr.Dataset, variable_netcdf_attr_name: str, formatted_date: str,
                           lat: float, lat_resolution: float, half_lat_frame: int,
                           lon: float, lon_resolution: float, half_lon_frame: int,
@@ -32,43 +170,378 @@ def extract_square_region(dataset: xr.Dataset, variable_netcdf_attr_name: str, f
                           lat_netcdf_attr_name: str = 'latitude',
                           lon_netcdf_attr_name: str = 'longitude',
                           has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
-                          dask_scheduler: str = 'single-threaded') -> xr.DataArray:
+                          dask_scheduler: str = 'single-threaded', dtype: np.dtype = None) -> xr.DataArray:
+    region = select_square_region(dataset=dataset, variable_netcdf_attr_name=variable_netcdf_attr_name,
+                                  formatted_date=formatted_date, lat=lat, lat_resolution=lat_resolution,
+                                  half_lat_frame=half_lat_frame, lon=lon, lon_resolution=lon_resolution,
+                                  half_lon_frame=half_lon_frame, variable_level=variable_level,
+                                  level_netcdf_attr_name=level_netcdf_attr_name,
+                                  time_netcdf_attr_name=time_netcdf_attr_name,
+                                  lat_netcdf_attr_name=lat_netcdf_attr_name, lon_netcdf_attr_name=lon_netcdf_attr_name,
+                                  has_to_round=has_to_round, lat_nb_decimal=lat_nb_decimal,
+                                  lon_nb_decimal=lon_nb_decimal)
+    return compute_square_regions([region], dask_scheduler, dtype)[0]
+
+
+# Select (lazily, nothing is read) the region that centers the given lat/lon location.
+# See compute_square_regions.
+def select_square_region(dataset: NetcdfDataset, variable_netcdf_attr_name: str, formatted_date: str,
+                         lat: float, lat_resolution: float, half_lat_frame: int,
+                         lon: float, lon_resolution: float, half_lon_frame: int,
+                         variable_level: int = None, level_netcdf_attr_name: str = 'level',
+                         time_netcdf_attr_name: str = 'time',
+                         lat_netcdf_attr_name: str = 'latitude',
+                         lon_netcdf_attr_name: str = 'longitude',
+                         has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None)\
+                         -> xr.DataArray:
+    return select_square_regions(dataset=dataset, variable_netcdf_attr_name=variable_netcdf_attr_name,
+                                 formatted_dates=[formatted_date], lats=[lat], lat_resolution=lat_resolution,
+                                 half_lat_frame=half_lat_frame, lons=[lon], lon_resolution=lon_resolution,
+                                 half_lon_frame=half_lon_frame, variable_level=variable_level,
+                                 level_netcdf_attr_name=level_netcdf_attr_name,
+                                 time_netcdf_attr_name=time_netcdf_attr_name,
+                                 lat_netcdf_attr_name=lat_netcdf_attr_name, lon_netcdf_attr_name=lon_netcdf_attr_name,
+                                 has_to_round=has_to_round, lat_nb_decimal=lat_nb_decimal,
+                                 lon_nb_decimal=lon_nb_decimal)[0]
+
+
+# Select (lazily, nothing is read) the regions that center the given lat/lon locations, at the given dates
+# (same length sequences). The bounds of the regions are computed at once (see compute_square_region_bounds).
+# The latitudes and the longitudes must be regular grids (of the given resolutions): the regions are selected
+# by position, the positions being computed from the bounds instead of being looked up in the indexes.
+# The regions of a netCDF4 dataset (see NetcdfBackend) are read right away, without the coordinates.
+# See compute_square_regions.
+def select_square_regions(dataset: NetcdfDataset, variable_netcdf_attr_name: str, formatted_dates: Sequence[str],
+                          lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                          lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                          variable_level: int = None, level_netcdf_attr_name: str = 'level',
+                          time_netcdf_attr_name: str = 'time',
+                          lat_netcdf_attr_name: str = 'latitude',
+                          lon_netcdf_attr_name: str = 'longitude',
+                          has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None)\
+                          -> List[xr.DataArray]:
+    lat_grid = __get_grid(dataset, lat_netcdf_attr_name, lat_resolution)
+    lon_grid = __get_grid(dataset, lon_netcdf_attr_name, lon_resolution)
+    lat_mins, lat_maxs, lon_mins, lon_maxs = \
+        compute_square_region_bounds(lats=lats, lat_resolution=lat_resolution, half_lat_frame=half_lat_frame,
+                                     lons=lons, lon_resolution=lon_resolution, half_lon_frame=half_lon_frame,
+                                     is_lat_descending=lat_grid[1] < 0,
+                                     has_to_round=has_to_round, lat_nb_decimal=lat_nb_decimal,
+                                     lon_nb_decimal=lon_nb_decimal)
+    lat_starts, lat_stops = __compute_positions(lat_grid, lat_mins, lat_maxs)
+    lon_starts, lon_stops = __compute_positions(lon_grid, lon_mins, lon_maxs)
+
+    time_positions = __get_positions(dataset, time_netcdf_attr_name, formatted_dates)
+    if variable_level:
+        level_position = __get_position(dataset, level_netcdf_attr_name, variable_level)
+
+    select_region = __get_region_selector(dataset, variable_netcdf_attr_name)
+    result = list()
+    for time_position, lat_start, lat_stop, lon_start, lon_stop in zip(time_positions, lat_starts.tolist(),
+                                                                       lat_stops.tolist(), lon_starts.tolist(),
+                                                                       lon_stops.tolist()):
+        indexers = dict()
+        indexers[time_netcdf_attr_name] = time_position
+        indexers[lat_netcdf_attr_name] = slice(lat_start, lat_stop)
+        indexers[lon_netcdf_attr_name] = slice(lon_start, lon_stop)
+
+        if variable_level:
+            indexers[level_netcdf_attr_name] = level_position
+
+        result.append(select_region(indexers))
+    return result
+
+
+# The operations that depend on the backend (see NetcdfBackend) are dispatched on the type of the dataset.
+
+# Return the function that selects a region of the given variable from the positions of the region (indexers).
+@functools.singledispatch
+def __get_region_selector(dataset: xr.Dataset, variable_netcdf_attr_name: str) \
+        -> Callable[[Mapping[str, Union[int, slice, np.ndarray]]], xr.DataArray]:
+    return dataset[variable_netcdf_attr_name].isel
+
+
+@__get_region_selector.register(netCDF4.Dataset)
+def __get_netcdf4_region_selector(dataset: netCDF4.Dataset, variable_netcdf_attr_name: str) \
+        -> Callable[[Mapping[str, Union[int, slice, np.ndarray]]], xr.DataArray]:
+    variable = dataset.variables[variable_netcdf_attr_name]
+    return functools.partial(__read_netcdf4_region, variable, __get_netcdf4_decoded_dtype(variable))
+
+
+# Return the dtype of the decoded values of the given netCDF4 variable, as the CF decoding of xarray does:
+# the packed variables take the dtype of their scale_factor/add_offset (float64 for the 32 bits integers or when
+# these attributes are not floats) and the integers that only have missing values are decoded as floats (float32
+# for the integers of up to 16 bits, float64 otherwise). The dtype doesn't depend on the values of the regions.
+def __get_netcdf4_decoded_dtype(variable: netCDF4.Variable) -> np.dtype:
+    dtype = np.dtype(variable.dtype)
+    attr_names = variable.ncattrs()
+    packing_dtypes = [np.asarray(variable.getncattr(attr_name)).dtype
+                      for attr_name in __CF_PACKING_ATTR_NAMES if attr_name in attr_names]
+    if packing_dtypes:
+        packing_dtype = np.result_type(*packing_dtypes)
+        if packing_dtype.kind != 'f' or (dtype.kind in 'iu' and dtype.itemsize >= 4):
+            return np.dtype(np.float64)
+        else:
+            return packing_dtype
+    elif dtype.kind in 'iub' and __CF_MASKING_ATTR_NAMES.intersection(attr_names):
+        return np.dtype(np.float32) if dtype.itemsize <= 2 else np.dtype(np.float64)
+    else:
+        return dtype
+
+
+__CF_PACKING_ATTR_NAMES: Tuple[str, ...] = ('scale_factor', 'add_offset')
+__CF_MASKING_ATTR_NAMES: Set[str] = {'_FillValue', 'missing_value'}
+
+
+# Read the region of the given netCDF4 variable, decoded in the given dtype (see __get_netcdf4_decoded_dtype).
+# Like xarray, the dimensions indexed by an integer are dropped and the masked values are replaced by NaN.
+def __read_netcdf4_region(variable: netCDF4.Variable, dtype: np.dtype,
+                          indexers: Mapping[str, Union[int, slice, np.ndarray]]) -> xr.DataArray:
+    keys = tuple(indexers.get(dim, slice(None)) for dim in variable.dimensions)
+    data = variable[keys]
+    if np.ma.isMaskedArray(data) and dtype.kind == 'f':
+        data = data.astype(dtype, copy=False).filled(np.nan)
+    else:
+        data = np.ma.getdata(data).astype(dtype, copy=False)
+    dims = [dim for dim, key in zip(variable.dimensions, keys) if not isinstance(key, (int, np.integer))]
+    return xr.DataArray(data, dims=dims)
+
+
+# Compute the bounds (lat_mins, lat_maxs, lon_mins, lon_maxs) of the regions that center the given lat/lon
+# locations, vectorized over the locations. The bounds are the ones of the slices of xarray (included).
+def compute_square_region_bounds(lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                                 lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                                 is_lat_descending: bool = False, has_to_round: bool = False,
+                                 lat_nb_decimal: int = None, lon_nb_decimal: int = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
     if has_to_round:
         if (not lat_nb_decimal) or (not lon_nb_decimal):
             raise ExtractionError("when has_to_round is true, lat_nb_decimal and lon_nb_decimal must be provided")
-        lat = coordinate_utils.round_nearest(lat, lat_resolution, lat_nb_decimal)
-        lon = coordinate_utils.round_nearest(lon, lon_resolution, lon_nb_decimal)
+        lats = coordinate_utils.round_nearest_array(lats, lat_resolution, lat_nb_decimal)
+        lons = coordinate_utils.round_nearest_array(lons, lon_resolution, lon_nb_decimal)
 
     # Minus lat_resolution because the upper bound in slice is included.
-    lat_min = (lat - half_lat_frame + lat_resolution)
-    lat_max = (lat + half_lat_frame)
+    lat_mins = (lats - half_lat_frame + lat_resolution)
+    lat_maxs = (lats + half_lat_frame)
     # Minus lon_resolution because the upper bound in slice is included.
-    lon_min = (lon - half_lon_frame)
-    lon_max = (lon + half_lon_frame - lon_resolution)
-
-    lat_series = dataset[lat_netcdf_attr_name]
+    lon_mins = (lons - half_lon_frame)
+    lon_maxs = (lons + half_lon_frame - lon_resolution)
 
     # Switching lat min and max.
-    if lat_series[0] > lat_series[-1]:
-        tmp = lat_min
-        lat_min = lat_max
-        lat_max = tmp
-        del tmp
-
-    indexers = dict()
-    indexers[time_netcdf_attr_name] = formatted_date
-    indexers[lat_netcdf_attr_name] = slice(lat_min, lat_max)
-    indexers[lon_netcdf_attr_name] = slice(lon_min, lon_max)
-
-    with dask.config.set(scheduler=dask_scheduler):
-        if variable_level:
-            indexers[level_netcdf_attr_name] = variable_level
+    if is_lat_descending:
+        lat_mins, lat_maxs = lat_maxs, lat_mins
+
+    return lat_mins, lat_maxs, lon_mins, lon_maxs
+
+
+# Tolerance on the positions computed from the bounds of the regions (see __compute_positions), in number of
+# grid steps. It absorbs the floating point errors.
+__POSITION_TOLERANCE: float = 1e-6
+
+# Tolerance on the positions of the coordinate values computed from the resolution (see __get_grid), in number of
+# grid steps. It absorbs the floating point errors of the coordinates (e.g. float32).
+__GRID_TOLERANCE: float = 1e-3
+
+# Cache of the invariants of the opened datasets (grids, positions of the labels in the indexes), so as to
+# compute them only once per dataset. The key is the id of the dataset: the entries of a dataset are removed
+# when the dataset is garbage collected.
+__DATASET_CACHES: Dict[int, Dict[Tuple[str, str, any], any]] = dict()
+
+
+def __get_dataset_cache(dataset: NetcdfDataset) -> Dict[Tuple[str, str, any], any]:
+    key = id(dataset)
+    result = __DATASET_CACHES.get(key, None)
+    if result is None:
+        result = dict()
+        __DATASET_CACHES[key] = result
+        weakref.finalize(dataset, __DATASET_CACHES.pop, key, None)
+    return result
+
+
+# Return the first value of the given coordinate, its step (signed resolution: negative when the values are
+# descending) and its number of values. Raise an ExtractionError if the coordinate doesn't have the given resolution
+# (the positions computed from the resolution would select other regions).
+def __get_grid(dataset: NetcdfDataset, coordinate_netcdf_attr_name: str, resolution: float) \
+        -> Tuple[float, float, int]:
+    cache = __get_dataset_cache(dataset)
+    key = ('grid', coordinate_netcdf_attr_name, resolution)
+    result = cache.get(key, None)
+    if result is None:
+        values, _ = __get_coordinate(dataset, coordinate_netcdf_attr_name)
+        if len(values) > 1:
+            coordinate_resolution = abs(float(values[1]) - float(values[0]))
+            second_position = coordinate_resolution / resolution
+            last_position = abs(float(values[-1]) - float(values[0])) / resolution
+            if abs(second_position - 1) > __GRID_TOLERANCE or \
+               abs(last_position - (len(values) - 1)) > __GRID_TOLERANCE:
+                msg = f"the resolution of the coordinate '{coordinate_netcdf_attr_name}' " +\
+                      f"({coordinate_resolution}) doesn't match the resolution {resolution}"
+                raise ExtractionError(msg)
+        step = -resolution if values[0] > values[-1] else resolution
+        result = (float(values[0]), step, len(values))
+        cache[key] = result
+    return result
+
+
+# Return the positions (starts and stops, for isel) of the given slice bounds (included, as for sel),
+# vectorized over the bounds. The positions are clipped to the grid, as sel does.
+def __compute_positions(grid: Tuple[float, float, int], starts: np.ndarray, stops: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    first_value, step, nb_values = grid
+    start_positions = np.ceil((starts - first_value) / step - __POSITION_TOLERANCE)
+    stop_positions = np.floor((stops - first_value) / step + __POSITION_TOLERANCE) + 1
+    return np.clip(start_positions, 0, nb_values).astype(np.int64), \
+        np.clip(stop_positions, 0, nb_values).astype(np.int64)
+
+
+# Return the position of the given label in the index of the given coordinate (see pandas.Index.get_loc).
+def __get_position(dataset: NetcdfDataset, coordinate_netcdf_attr_name: str, label: any) \
+        -> Union[int, slice, np.ndarray]:
+    positions = __get_label_positions(dataset, coordinate_netcdf_attr_name)
+    result = positions.get(label, None)
+    if result is None:
+        try:
+            result = __get_index(dataset, coordinate_netcdf_attr_name).get_loc(label)
+        except KeyError as e:
+            msg = f"'{label}' not found in the coordinate '{coordinate_netcdf_attr_name}'"
+            raise ExtractionError(msg, e)
+        positions[label] = result
+    return result
+
+
+# Return the positions of the given labels (e.g. the formatted dates of a block of extractions), each distinct
+# label being resolved once per dataset (see __get_position).
+def __get_positions(dataset: NetcdfDataset, coordinate_netcdf_attr_name: str, labels: Sequence[any]) \
+        -> List[Union[int, slice, np.ndarray]]:
+    positions = __get_label_positions(dataset, coordinate_netcdf_attr_name)
+    for label in set(labels).difference(positions):
+        __get_position(dataset, coordinate_netcdf_attr_name, label)
+    return [positions[label] for label in labels]
+
+
+# Return the mapping label -> position of the labels of the given coordinate resolved so far (cached).
+def __get_label_positions(dataset: NetcdfDataset, coordinate_netcdf_attr_name: str) \
+        -> Dict[any, Union[int, slice, np.ndarray]]:
+    cache = __get_dataset_cache(dataset)
+    key = ('positions', coordinate_netcdf_attr_name, None)
+    result = cache.get(key, None)
+    if result is None:
+        result = dict()
+        cache[key] = result
+    return result
+
+
+# Return the values and the attributes of the given coordinate.
+@functools.singledispatch
+def __get_coordinate(dataset: xr.Dataset, coordinate_netcdf_attr_name: str) -> Tuple[np.ndarray, Mapping[str, any]]:
+    coordinate = dataset[coordinate_netcdf_attr_name]
+    return coordinate.values, coordinate.attrs
+
+
+@__get_coordinate.register(netCDF4.Dataset)
+def __get_netcdf4_coordinate(dataset: netCDF4.Dataset, coordinate_netcdf_attr_name: str) \
+        -> Tuple[np.ndarray, Mapping[str, any]]:
+    coordinate = dataset.variables[coordinate_netcdf_attr_name]
+    return np.ma.getdata(coordinate[:]), coordinate.__dict__
+
+
+# Return the index of the given coordinate (cached).
+def __get_index(dataset: NetcdfDataset, coordinate_netcdf_attr_name: str) -> pd.Index:
+    cache = __get_dataset_cache(dataset)
+    key = ('index', coordinate_netcdf_attr_name, None)
+    result = cache.get(key, None)
+    if result is None:
+        result = __build_index(dataset, coordinate_netcdf_attr_name)
+        cache[key] = result
+    return result
+
+
+# The times of the xarray datasets opened without decoding them (see OPEN_DATASET_DEFAULT_OPTIONS) are decoded.
+@functools.singledispatch
+def __build_index(dataset: xr.Dataset, coordinate_netcdf_attr_name: str) -> pd.Index:
+    values, attrs = __get_coordinate(dataset, coordinate_netcdf_attr_name)
+    if __has_time_units(attrs):
+        return __decode_times(values, attrs)
+    else:
+        return dataset.indexes[coordinate_netcdf_attr_name]
+
+
+# The index of a netCDF4 dataset is built from the values of the coordinate, decoded as dates when the coordinate
+# has time units.
+@__build_index.register(netCDF4.Dataset)
+def __build_netcdf4_index(dataset: netCDF4.Dataset, coordinate_netcdf_attr_name: str) -> pd.Index:
+    values, attrs = __get_coordinate(dataset, coordinate_netcdf_attr_name)
+    if __has_time_units(attrs):
+        return __decode_times(values, attrs)
+    else:
+        return pd.Index(values)
+
+
+def __has_time_units(coordinate_attrs: Mapping[str, any]) -> bool:
+    return ' since ' in coordinate_attrs.get('units', '')
+
 
-        result = dataset[variable_netcdf_attr_name].sel(indexers=indexers).compute()
-        # Drop the coordinates (time, latitude and longitude) so as to concatenate
-        # the extracted region so as to stack several of them and make a channel.
-        result = result.drop(result.coords)
-        return result
+def __decode_times(values: np.ndarray, coordinate_attrs: Mapping[str, any]) -> pd.Index:
+    units = coordinate_attrs['units']
+    calendar = coordinate_attrs.get('calendar', 'standard')
+    try:
+        return pd.DatetimeIndex(netCDF4.num2date(values, units, calendar, only_use_cftime_datetimes=False,
+                                                 only_use_python_datetimes=True))
+    except ValueError:
+        # Calendars that are not compatible with the python dates (e.g. noleap).
+        return xr.CFTimeIndex(netCDF4.num2date(values, units, calendar))
+
+
+# Compute the given selected regions (see select_square_region) at once: the dask backed regions
+# are computed within a single dask graph.
+# dtype: the dtype of the returned regions (e.g. np.float32), the dtype of the netcdf variable when None. The values
+# are cast after the scale factors and the missing values are applied (when the file is opened).
+# has_to_compute_dask: when false, the dask backed regions are returned uncomputed (without their coordinates), so
+# as the caller computes them within its own dask graph (e.g. XarrayRpnCalculator). The other regions are loaded.
+def compute_square_regions(regions: Sequence[xr.DataArray], dask_scheduler: str = 'single-threaded',
+                           dtype: np.dtype = None, has_to_compute_dask: bool = True) -> List[xr.DataArray]:
+    # The scheduler is given to dask.compute rather than set in the dask configuration, which is global:
+    # regions are computed concurrently by compute_square_regions_stream.
+    # Drop the coordinates (time, latitude and longitude) so as to concatenate
+    # the extracted region so as to stack several of them and make a channel.
+    # Dropped before the computation, so as the coordinates are not computed.
+    regions = [region.drop_vars(list(region.coords)) for region in regions]
+    if dtype is not None:
+        # The dask backed regions are cast within the dask graph: less data to copy.
+        regions = [region.astype(dtype, copy=False) if region.chunks is not None else region for region in regions]
+    if has_to_compute_dask:
+        computed_regions = dask.compute(*regions, scheduler=dask_scheduler)
+        # Regions that are not backed by dask are returned as they are by dask.compute, then loaded.
+        result = [region.compute() for region in computed_regions]
+    else:
+        result = [region.compute() if region.chunks is None else region for region in regions]
+    if dtype is not None:
+        result = [region.astype(dtype, copy=False) for region in result]
+    return result
+
+
+# Compute the given batches of selected regions (see compute_square_regions) and yield them in order.
+# The next batches (up to lookahead) are computed in background threads, so as the reading of the netcdf files
+# overlaps the processing of the current batch by the caller. No prefetching when lookahead is zero.
+def compute_square_regions_stream(region_batches: Iterable[Sequence[xr.DataArray]],
+                                  lookahead: int = PREFETCH_LOOKAHEAD,
+                                  dask_scheduler: str = 'single-threaded',
+                                  dtype: np.dtype = None) -> Iterator[List[xr.DataArray]]:
+    if lookahead < 1:
+        for regions in region_batches:
+            yield compute_square_regions(regions, dask_scheduler, dtype)
+        return
+    region_batches = iter(region_batches)
+    with ThreadPoolExecutor(max_workers=lookahead) as executor:
+        futures = deque(executor.submit(compute_square_regions, regions, dask_scheduler, dtype)
+                        for regions in islice(region_batches, lookahead))
+        while futures:
+            result = futures.popleft().result()
+            for regions in islice(region_batches, 1):
+                futures.append(executor.submit(compute_square_regions, regions, dask_scheduler, dtype))
+            yield result
 
 
 def __era5_unit_test_extraction(variable_name: str,
@@ -95,7 +568,8 @@ def __era5_unit_test_extraction(variable_name: str,
             '.as1e5.GLOBAL_025.nc'
 
     print(f"> opening '{netcdf_file_path}'")
-    with open_netcdf(netcdf_file_path) as dataset:
+    dataset = open_netcdf(netcdf_file_path)
+    try:
         print("> extracting region")
         extracted_region = extract_square_region(dataset=dataset, variable_netcdf_attr_name=variable_name,
                                                  formatted_date=formatted_date, variable_level=variable_level,
@@ -108,6 +582,8 @@ def __era5_unit_test_extraction(variable_name: str,
         plt.imshow(extracted_region, cmap='gist_rainbow_r', interpolation="none")
         plt.show()
         return extracted_region
+    finally:
+        close_netcdf(dataset)
 
 
 def __test_simple_variable():
@@ -133,7 +609,166 @@ def __test_multilevel_variable():
     return __era5_unit_test_extraction(variable_name, year, month, day, hour, lat, lon, variable_level)
 
 
+# The label selection of the regions (xarray.DataArray.sel) that preceded the selection by position.
+def __test_select_square_region_by_label(data_array: xr.DataArray, formatted_date: str, lat: float,
+                                         lat_resolution: float, half_lat_frame: int, lon: float,
+                                         lon_resolution: float, half_lon_frame: int, lat_nb_decimal: int,
+                                         lon_nb_decimal: int) -> xr.DataArray:
+    lat = coordinate_utils.round_nearest(lat, lat_resolution, lat_nb_decimal)
+    lon = coordinate_utils.round_nearest(lon, lon_resolution, lon_nb_decimal)
+    lat_min = (lat - half_lat_frame + lat_resolution)
+    lat_max = (lat + half_lat_frame)
+    lon_min = (lon - half_lon_frame)
+    lon_max = (lon + half_lon_frame - lon_resolution)
+    if data_array['latitude'][0] > data_array['latitude'][-1]:
+        lat_min, lat_max = lat_max, lat_min
+    return data_array.sel(time=formatted_date, latitude=slice(lat_min, lat_max), longitude=slice(lon_min, lon_max))
+
+
+def __test_create_dataset(lat_resolution: float, lon_resolution: float, coordinate_dtype: np.dtype,
+                          is_lat_descending: bool) -> xr.Dataset:
+    lats = (np.arange(-int(round(90 / lat_resolution)), int(round(90 / lat_resolution)) + 1) *
+            lat_resolution).astype(coordinate_dtype)
+    if is_lat_descending:
+        lats = lats[::-1]
+    lons = (np.arange(0, int(round(360 / lon_resolution))) * lon_resolution).astype(coordinate_dtype)
+    times = pd.date_range('2000-10-01', periods=4, freq='6h')
+    data = np.random.default_rng(0).random((len(times), len(lats), len(lons)), dtype=np.float32)
+    return xr.Dataset({'msl': (('time', 'latitude', 'longitude'), data)},
+                      coords={'time': times, 'latitude': lats, 'longitude': lons})
+
+
+# The regions selected by position must match the regions selected by label. On some grids (e.g. 0.1° float64
+# coordinates), the label selection misses or adds a row or a column because of the floating point errors, while
+# the regions selected by position always have the expected shape.
+def __test_select_square_regions():
+    half_frame = 2
+    nb_regions = 200
+    rng = np.random.default_rng(1)
+    for resolution, nb_decimal, coordinate_dtype, is_lat_descending in ((0.25, 2, np.float32, True),
+                                                                       (0.25, 2, np.float64, False),
+                                                                       (0.1, 1, np.float32, True),
+                                                                       (0.1, 1, np.float64, True),
+                                                                       (0.1, 1, np.float64, False)):
+        dataset = __test_create_dataset(resolution, resolution, coordinate_dtype, is_lat_descending)
+        formatted_dates = rng.choice(['2000-10-01T00', '2000-10-01T06', '2000-10-01T18'], nb_regions).tolist()
+        lats = rng.uniform(-85, 85, nb_regions)
+        lons = rng.uniform(half_frame, 360 - half_frame, nb_regions)
+        regions = compute_square_regions(select_square_regions(dataset, 'msl', formatted_dates, lats, resolution,
+                                                               half_frame, lons, resolution, half_frame,
+                                                               has_to_round=True, lat_nb_decimal=nb_decimal,
+                                                               lon_nb_decimal=nb_decimal))
+        expected_shape = (int(round(2 * half_frame / resolution)), int(round(2 * half_frame / resolution)))
+        nb_mismatches = 0
+        for formatted_date, lat, lon, region in zip(formatted_dates, lats, lons, regions):
+            assert region.shape == expected_shape
+            expected_region = __test_select_square_region_by_label(dataset['msl'], formatted_date, lat, resolution,
+                                                                   half_frame, lon, resolution, half_frame,
+                                                                   nb_decimal, nb_decimal)
+            if expected_region.shape == expected_shape:
+                assert np.array_equal(region.values, expected_region.values)
+            else:
+                nb_mismatches = nb_mismatches + 1
+        print(f"> resolution {resolution} ({np.dtype(coordinate_dtype)}): {nb_mismatches} label selections "
+              f"out of {nb_regions} don't have the expected shape")
+    # The resolution must match the coordinates.
+    dataset = __test_create_dataset(0.5, 0.5, np.float32, True)
+    try:
+        select_square_regions(dataset, 'msl', ['2000-10-01T00'], [10.], 0.25, half_frame, [10.], 0.5, half_frame)
+        assert False
+    except ExtractionError:
+        pass
+
+
+def __test_netcdf_cache():
+    import os
+    import tempfile
+    global NETCDF_CACHE_SIZE
+    cache_size = NETCDF_CACHE_SIZE
+    clear_netcdf_cache()
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        netcdf_file_paths = list()
+        for index in range(3):
+            netcdf_file_path = os.path.join(tmp_dir_path, f"{index}.nc")
+            __test_create_dataset(10., 10., np.float32, True).to_netcdf(netcdf_file_path)
+            netcdf_file_paths.append(netcdf_file_path)
+        try:
+            # The datasets are shared and reference counted.
+            dataset = open_netcdf(netcdf_file_paths[0])
+            assert open_netcdf(netcdf_file_paths[0]) is dataset
+            assert __NETCDF_CACHE[next(iter(__NETCDF_CACHE))][1] == 2
+            close_netcdf(dataset)
+            close_netcdf(dataset)
+            try:
+                close_netcdf(dataset)
+                assert False
+            except ExtractionError:
+                pass
+            # The released dataset stays open until it is evicted.
+            assert len(__NETCDF_CACHE) == 1
+            assert float(dataset['msl'][0, 0, 0]) >= 0
+
+            # The datasets in use are not evicted.
+            configure_netcdf_cache(1)
+            in_use_dataset = open_netcdf(netcdf_file_paths[1])
+            assert len(__NETCDF_CACHE) == 1  # The released dataset is evicted.
+            other_dataset = open_netcdf(netcdf_file_paths[2])
+            assert len(__NETCDF_CACHE) == 2
+            close_netcdf(other_dataset)  # The least recently used dataset not in use is evicted.
+            assert len(__NETCDF_CACHE) == 1
+            assert open_netcdf(netcdf_file_paths[1]) is in_use_dataset
+            close_netcdf(in_use_dataset)
+            close_netcdf(in_use_dataset)
+            assert len(__NETCDF_CACHE) == 1
+        finally:
+            clear_netcdf_cache()
+            configure_netcdf_cache(cache_size)
+    assert len(__NETCDF_CACHE) == 0
+
+
+# Both backends must decode the packed variables (e.g. ERA5: int16 with float64 scale_factor/add_offset) in the
+# same dtype, so that they produce identical regions.
+def __test_netcdf_backends():
+    import os
+    import tempfile
+    half_frame = 20
+    resolution = 10.
+    dataset = __test_create_dataset(resolution, resolution, np.float32, True)
+    msl = dataset['msl'] * 1000 + 100000
+    msl.loc['2000-10-01T00', 30., 20.] = np.nan
+    dataset['msl'] = msl
+    dataset['ta'] = xr.concat([msl / 500, msl / 400], dim=pd.Index([500, 850], name='level'))\
+        .transpose('time', 'level', 'latitude', 'longitude')
+    packing = {'dtype': 'int16', 'scale_factor': np.float64(0.0317), 'add_offset': np.float64(100500.123),
+               '_FillValue': np.int16(-32767)}
+    formatted_dates = ['2000-10-01T00', '2000-10-01T06', '2000-10-01T18']
+    lats = [30., -40., 60.]
+    lons = [20., 300., 100.]
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        netcdf_file_path = os.path.join(tmp_dir_path, 'packed.nc')
+        dataset.to_netcdf(netcdf_file_path, encoding={'msl': packing, 'ta': {**packing, 'add_offset': 250.}})
+        results = dict()
+        for backend in (NetcdfBackend.XARRAY, NetcdfBackend.NETCDF4):
+            packed_dataset = open_netcdf(netcdf_file_path, OPEN_DATASET_DEFAULT_OPTIONS, backend=backend)
+            try:
+                results[backend] = [np.stack([region.values for region in compute_square_regions(
+                    select_square_regions(packed_dataset, variable_netcdf_attr_name, formatted_dates, lats,
+                                          resolution, half_frame, lons, resolution, half_frame,
+                                          variable_level=variable_level))])
+                                    for variable_netcdf_attr_name, variable_level in (('msl', None), ('ta', 850))]
+            finally:
+                close_netcdf(packed_dataset)
+        clear_netcdf_cache()
+    for xarray_regions, netcdf4_regions in zip(results[NetcdfBackend.XARRAY], results[NetcdfBackend.NETCDF4]):
+        assert xarray_regions.dtype == netcdf4_regions.dtype == np.float64
+        assert np.array_equal(xarray_regions, netcdf4_regions, equal_nan=True)
+    assert np.isnan(results[NetcdfBackend.NETCDF4][0]).any()
+
+
 def __all_tests():
+    __test_select_square_regions()
+    __test_netcdf_cache()
+    __test_netcdf_backends()
     __test_simple_variable()
     __test_multilevel_variable()
 
@@ -9,6 +9,8 @@ Created on Wed Apr  3 13:26:39 2019
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.csv_option_names import CsvOptName
 from nxtensor.utils.db_types import DBType
+from nxtensor.utils.hdf5_formats import HDF5Format
+from nxtensor.utils.netcdf_backends import NetcdfBackend
 from nxtensor.yaml_serializable import YamlSerializable
 from nxtensor.variable import Variable
 from nxtensor.core.types import VariableId, LabelId, DBMetadataMapping
@@ -42,6 +44,22 @@ class ExtractionConfig(YamlSerializable):
         # Dask scheduler mode. See https://docs.dask.org/en/latest/scheduler-overview.html
         self.dask_scheduler: str = 'single-threaded'
 
+        # Library that reads the netcdf files (see NetcdfBackend).
+        self.netcdf_backend: NetcdfBackend = NetcdfBackend.XARRAY
+
+        # The dtype of the extracted images (e.g. 'float32'), the dtype of the netcdf variable when None.
+        self.region_dtype: str = None
+
+        # The maximum number of netcdf files kept open per process, across the extractions of the blocks
+        # (see xarray_extractions.configure_netcdf_cache). The default size when None.
+        self.netcdf_cache_size: int = None
+
+        # The format of the files of the extracted data blocks (see HDF5Format).
+        self.data_block_hdf5_format: HDF5Format = HDF5Format.COMPRESSED
+
+        # Write the extracted metadata blocks with pyarrow (see csv_utils.to_csv).
+        self.use_pyarrow_csv_writer: bool = False
+
         # x and y size of an image of the tensor.
         self.x_size: int = None
         self.y_size: int = None
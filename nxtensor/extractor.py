@@ -5,10 +5,12 @@ Created on Fri Apr 23 14:50:20 2020
 
 @author: sebastien@gardoll.fr
 """
-from typing import Dict, List, Mapping, Tuple, Type
+from typing import Dict, Iterable, List, Mapping, Tuple, Type, Union
 
 from nxtensor.exceptions import ConfigurationError
-from nxtensor.square_extractor import SquareRegionExtractionVisitor, RegionExtractionVisitor
+from nxtensor.square_extractor import SquareRegionExtractionVisitor, RegionExtractionVisitor, \
+    SquareRegionStackExtractionVisitor, RegionStackExtractionVisitor
+from nxtensor.utils.netcdf_backends import NetcdfBackend
 from nxtensor.utils.tensor_dimensions import TensorDimension
 from nxtensor.extraction import ExtractionShape
 from nxtensor.variable import VariableVisitor, SingleLevelVariable, MultiLevelVariable, ComputedVariable, Variable, \
@@ -18,6 +20,7 @@ from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period
 import nxtensor.core.xarray_extractions as xtract
 import nxtensor.utils.time_utils as tu
 
+import numpy as np
 import xarray as xr
 
 
@@ -26,6 +29,9 @@ class ExtractionVisitor(VariableVisitor):
     __EXTRACTOR_FACTORY: Mapping[ExtractionShape, Type[RegionExtractionVisitor]] = \
         {ExtractionShape.SQUARE: SquareRegionExtractionVisitor}
 
+    __STACK_EXTRACTOR_FACTORY: Mapping[ExtractionShape, Type[RegionStackExtractionVisitor]] = \
+        {ExtractionShape.SQUARE: SquareRegionStackExtractionVisitor}
+
     @staticmethod
     def __create_extractor(shape: ExtractionShape) -> Type[RegionExtractionVisitor]:
         try:
@@ -34,58 +40,103 @@ class ExtractionVisitor(VariableVisitor):
             msg = f"> [ERROR] unknown extraction shape '{shape}'"
             raise ConfigurationError(msg)
 
+    @staticmethod
+    def __create_stack_extractor(shape: ExtractionShape) -> Type[RegionStackExtractionVisitor]:
+        try:
+            return ExtractionVisitor.__STACK_EXTRACTOR_FACTORY[shape]
+        except KeyError:
+            msg = f"> [ERROR] unknown extraction shape '{shape}'"
+            raise ConfigurationError(msg)
+
     def __init__(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
                  half_lat_frame: int,
                  half_lon_frame: int, dask_scheduler: str = 'single-threaded',
-                 shape: ExtractionShape = ExtractionShape.SQUARE):
+                 shape: ExtractionShape = ExtractionShape.SQUARE,
+                 netcdf_backend: NetcdfBackend = NetcdfBackend.XARRAY, dtype: str = None):
         self.__period: Period = period
         self.__extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]] = extraction_metadata_blocks
         self.__half_lat_frame: int = half_lat_frame
         self.__half_lon_frame: int = half_lon_frame
         self.__dask_scheduler: str = dask_scheduler
         self.__shape: ExtractionShape = shape
+        self.__netcdf_backend: NetcdfBackend = netcdf_backend
+        # The dtype of the extracted regions, the dtype of the netcdf variable when None.
+        self.__dtype: str = dtype
         self.result: List[Tuple[LabelId, xr.DataArray, MetaDataBlock]] = list()
 
-    def __core_extraction(self, var: Variable, datasets: Mapping[VariableId, xr.Dataset]) -> None:
-
-        for label_id, extraction_metadata_block in self.__extraction_metadata_blocks:
-            extracted_regions: List[xr.DataArray] = list()
-            # The order of extraction_data_list must be deterministic so as all the channel
-            # match their extracted region line by line.
-            for extraction_data in extraction_metadata_block:
-                extractor = ExtractionVisitor.__create_extractor(self.__shape)(datasets=datasets,
-                                                                               extraction_data=extraction_data,
-                                                                               half_lat_frame=self.__half_lat_frame,
-                                                                               half_lon_frame=self.__half_lon_frame,
-                                                                               dask_scheduler=self.__dask_scheduler)
-                var.accept(extractor)
-                extracted_regions.append(extractor.get_result())
-
+    # extracted_region_batches: the extracted regions of each extraction metadata block, in the same order.
+    def __core_extraction(self, var: Variable,
+                          extracted_region_batches: Iterable[Union[List[xr.DataArray], np.ndarray]]) -> None:
+        for (label_id, extraction_metadata_block), extracted_regions in zip(self.__extraction_metadata_blocks,
+                                                                            extracted_region_batches):
             # dims are lost when instantiating a DataArray based on other DataArray objects.
             dims = (var.str_id, TensorDimension.X, TensorDimension.Y)
             # Stack the extracted regions in a xarray data array => data extraction_metadata_blocks.
             data = xr.DataArray(extracted_regions, dims=dims)
             self.result.append((label_id, data, extraction_metadata_block))
 
-        [dataset.close() for dataset in datasets.values()]
-
-    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+    # The regions of a block are selected at once, then the blocks are computed ahead
+    # (see xarray_extractions.compute_square_regions_stream).
+    def __batch_extraction(self, var: SingleLevelVariable, variable_level: int = None,
+                           level_netcdf_attr_name: str = 'level') -> None:
         time_dict = tu.from_time_list_to_dict(self.__period)
         netcdf_file_path = var.compute_netcdf_file_path(time_dict)
-        datasets = {var.str_id: xtract.open_netcdf(netcdf_file_path)}
-        self.__core_extraction(var, datasets)
+        dataset = xtract.open_netcdf(netcdf_file_path, backend=self.__netcdf_backend)
+        try:
+            extractor_class = ExtractionVisitor.__create_extractor(self.__shape)
+            # The order of extraction_data_list must be deterministic so as all the channel
+            # match their extracted region line by line.
+            # noinspection PyTypeChecker
+            selected_region_batches = (extractor_class.select_regions(var, dataset, extraction_metadata_block,
+                                                                      self.__half_lat_frame, self.__half_lon_frame,
+                                                                      variable_level, level_netcdf_attr_name)
+                                       for _, extraction_metadata_block in self.__extraction_metadata_blocks)
+            extracted_region_batches = xtract.compute_square_regions_stream(selected_region_batches,
+                                                                            dask_scheduler=self.__dask_scheduler,
+                                                                            dtype=self.__dtype)
+            try:
+                self.__core_extraction(var, extracted_region_batches)
+            finally:
+                # Wait for the batches computed ahead before releasing the dataset.
+                extracted_region_batches.close()
+        finally:
+            xtract.close_netcdf(dataset)
+
+    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+        self.__batch_extraction(var)
 
     def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
-        self.visit_single_level_variable(var)
+        self.__batch_extraction(var, var.level, var.level_netcdf_attr_name)
 
     def visit_computed_variable(self, var: ComputedVariable) -> None:
         time_dict = tu.from_time_list_to_dict(self.__period)
         visitor = VariableNetcdfFilePathVisitor(time_dict)
         var.accept(visitor)
         datasets: Dict[VariableId, xr.Dataset] = dict()
-        for var_id, netcdf_file_path in visitor.result.items():
-            datasets[var_id] = xtract.open_netcdf(netcdf_file_path)
-        self.__core_extraction(var, datasets)
+        try:
+            for var_id, netcdf_file_path in visitor.result.items():
+                datasets[var_id] = xtract.open_netcdf(netcdf_file_path, backend=self.__netcdf_backend)
+            extractor_class = ExtractionVisitor.__create_stack_extractor(self.__shape)
+            extracted_region_batches = (self.__extract_stack(extractor_class, var, datasets,
+                                                             extraction_metadata_block)
+                                        for _, extraction_metadata_block in self.__extraction_metadata_blocks)
+            self.__core_extraction(var, extracted_region_batches)
+        finally:
+            # Release the datasets opened so far.
+            for dataset in datasets.values():
+                xtract.close_netcdf(dataset)
+
+    # Return the stack of the regions of the given block. The computation expression is evaluated with the dtype of
+    # the netcdf variables, then the stack is cast.
+    def __extract_stack(self, extractor_class: Type[RegionStackExtractionVisitor], var: Variable,
+                        datasets: Mapping[VariableId, xr.Dataset], extraction_metadata_block: MetaDataBlock) \
+            -> np.ndarray:
+        extractor = extractor_class(datasets=datasets, extraction_data_list=extraction_metadata_block,
+                                    half_lat_frame=self.__half_lat_frame, half_lon_frame=self.__half_lon_frame,
+                                    dask_scheduler=self.__dask_scheduler)
+        var.accept(extractor)
+        result = extractor.get_result().values
+        return result if self.__dtype is None else result.astype(self.__dtype, copy=False)
 
     def get_result(self) -> List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]:
         return self.result
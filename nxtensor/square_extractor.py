@@ -6,12 +6,16 @@ Created on Fri Apr 17 17:00:00 2020
 @author: sebastien@gardoll.fr
 """
 from abc import abstractmethod
-from typing import Dict, Union, Mapping
+from typing import Dict, List, Union, Mapping, Sequence
 
+import dask.array as da
+import numpy as np
 import xarray as xr
 import nxtensor.core.xarray_extractions as xtract
 import nxtensor.utils.naming_utils
+import nxtensor.utils.time_utils as tu
 from nxtensor.utils.coordinates import Coordinate
+from nxtensor.utils.tensor_dimensions import TensorDimension
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.xarray_rpn_calulator import XarrayRpnCalculator
 from nxtensor.variable import MultiLevelVariable, SingleLevelVariable, ComputedVariable, \
@@ -36,6 +40,16 @@ class RegionExtractionVisitor(VariableVisitor):
         # noinspection PyTypeChecker
         self._result: xr.DataArray = None
 
+    # Select (lazily) the regions of the given single or multi level variable, for all the given extraction data
+    # at once. The regions must be computed by the caller (see xarray_extractions.compute_square_regions).
+    @staticmethod
+    @abstractmethod
+    def select_regions(var: SingleLevelVariable, dataset: xr.Dataset,
+                       extraction_data_list: Sequence[Mapping[Union[Coordinate, TimeResolution], Union[int, float]]],
+                       half_lat_frame: int, half_lon_frame: int, variable_level: int = None,
+                       level_netcdf_attr_name: str = 'level') -> List[xr.DataArray]:
+        pass
+
 
 class SquareRegionExtractionVisitor(RegionExtractionVisitor):
 
@@ -44,13 +58,34 @@ class SquareRegionExtractionVisitor(RegionExtractionVisitor):
                  half_lon_frame: int, dask_scheduler: str = 'single-threaded'):
         super().__init__(datasets, extraction_data, half_lat_frame, half_lon_frame, dask_scheduler)
 
+    @staticmethod
+    def select_regions(var: SingleLevelVariable, dataset: xr.Dataset,
+                       extraction_data_list: Sequence[Mapping[Union[Coordinate, TimeResolution], Union[int, float]]],
+                       half_lat_frame: int, half_lon_frame: int, variable_level: int = None,
+                       level_netcdf_attr_name: str = 'level') -> List[xr.DataArray]:
+        formatted_dates = tu.format_dates(var.date_template, extraction_data_list)
+        lats = [extraction_data[Coordinate.LAT] for extraction_data in extraction_data_list]
+        lons = [extraction_data[Coordinate.LON] for extraction_data in extraction_data_list]
+        return xtract.select_square_regions(dataset=dataset, variable_netcdf_attr_name=var.netcdf_attr_name,
+                                            formatted_dates=formatted_dates, lats=lats,
+                                            lat_resolution=var.lat_resolution, half_lat_frame=half_lat_frame,
+                                            lons=lons, lon_resolution=var.lon_resolution,
+                                            half_lon_frame=half_lon_frame, variable_level=variable_level,
+                                            level_netcdf_attr_name=level_netcdf_attr_name,
+                                            time_netcdf_attr_name=var.time_netcdf_attr_name,
+                                            lat_netcdf_attr_name=var.lat_netcdf_attr_name,
+                                            lon_netcdf_attr_name=var.lon_netcdf_attr_name,
+                                            has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
+                                            lon_nb_decimal=var.lon_nb_decimal)
+
     def __bootstrap(self, var: SingleLevelVariable) -> str:
         # month2d, day2d and hour2d are computed when calling convert_block_to_dict function from module
         # xarray_channel_extraction.
         formatted_date = var.date_template.format(**self._extraction_data)
         return formatted_date
 
-    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+    def __extract_region(self, var: SingleLevelVariable, variable_level: int = None,
+                         level_netcdf_attr_name: str = 'level') -> None:
         if var.str_id not in self._extracted_regions:
             formatted_date = self.__bootstrap(var)
             self._result = xtract.extract_square_region(dataset=self._datasets[var.str_id],
@@ -62,6 +97,8 @@ class SquareRegionExtractionVisitor(RegionExtractionVisitor):
                                                         lon=self._extraction_data[Coordinate.LON],
                                                         lon_resolution=var.lon_resolution,
                                                         half_lon_frame=self._half_lon_frame,
+                                                        variable_level=variable_level,
+                                                        level_netcdf_attr_name=level_netcdf_attr_name,
                                                         time_netcdf_attr_name=var.time_netcdf_attr_name,
                                                         lat_netcdf_attr_name=var.lat_netcdf_attr_name,
                                                         lon_netcdf_attr_name=var.lon_netcdf_attr_name,
@@ -70,26 +107,11 @@ class SquareRegionExtractionVisitor(RegionExtractionVisitor):
                                                         dask_scheduler=self._dask_scheduler)
             self._extracted_regions[var.str_id] = self._result
 
+    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+        self.__extract_region(var)
+
     def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
-        if var.str_id not in self._extracted_regions:
-            formatted_date = self.__bootstrap(var)
-            self._result = xtract.extract_square_region(dataset=self._datasets[var.str_id],
-                                                        variable_netcdf_attr_name=var.netcdf_attr_name,
-                                                        formatted_date=formatted_date,
-                                                        lat=self._extraction_data[Coordinate.LAT],
-                                                        lat_resolution=var.lat_resolution,
-                                                        half_lat_frame=self._half_lat_frame,
-                                                        lon=self._extraction_data[Coordinate.LON],
-                                                        lon_resolution=var.lon_resolution,
-                                                        half_lon_frame=self._half_lon_frame, variable_level=var.level,
-                                                        level_netcdf_attr_name=var.level_netcdf_attr_name,
-                                                        time_netcdf_attr_name=var.time_netcdf_attr_name,
-                                                        lat_netcdf_attr_name=var.lat_netcdf_attr_name,
-                                                        lon_netcdf_attr_name=var.lon_netcdf_attr_name,
-                                                        has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
-                                                        lon_nb_decimal=var.lon_nb_decimal,
-                                                        dask_scheduler=self._dask_scheduler)
-            self._extracted_regions[var.str_id] = self._result
+        self.__extract_region(var, variable_level=var.level, level_netcdf_attr_name=var.level_netcdf_attr_name)
 
     def visit_computed_variable(self, var: ComputedVariable) -> None:
         if var.str_id not in self._extracted_regions:
@@ -114,6 +136,116 @@ class SquareRegionExtractionVisitor(RegionExtractionVisitor):
         return self._result
 
 
+class RegionStackExtractionVisitor(VariableVisitor):
+    @abstractmethod
+    def __init__(self, datasets: Mapping[VariableId, xr.Dataset],
+                 extraction_data_list: Sequence[Mapping[Union[Coordinate, TimeResolution], Union[int, float]]],
+                 half_lat_frame: int, half_lon_frame: int, dask_scheduler: str = 'single-threaded'):
+        # The stacks of the extracted regions (one region per extraction data) of the variables.
+        # Computed variables may contain computed variables, recursively !
+        self._stacks: Dict[VariableId, xr.DataArray] = dict()
+        self._datasets: Mapping[VariableId, xr.Dataset] = datasets
+        self._extraction_data_list: Sequence[Mapping[Union[Coordinate, TimeResolution], Union[int, float]]] = \
+            extraction_data_list
+        self._half_lat_frame: int = half_lat_frame
+        self._half_lon_frame: int = half_lon_frame
+        self._dask_scheduler: str = dask_scheduler
+        # Regions selected but not computed yet (only while selecting the regions of a computed variable).
+        # noinspection PyTypeChecker
+        self._selected_regions: Dict[VariableId, List[xr.DataArray]] = None
+        # noinspection PyTypeChecker
+        self._result: xr.DataArray = None
+
+
+# Extract the regions of a variable for all the given extraction data at once (a stack of regions).
+# The regions of the variables that compose a computed variable are computed at once and copied into
+# preallocated stacks, so as the computation expression is evaluated once on the stacks, instead of once per
+# extraction data. The dask backed regions are stacked lazily instead: the selections, the stacks and the
+# computation expression make a single dask graph, computed once (see XarrayRpnCalculator).
+class SquareRegionStackExtractionVisitor(RegionStackExtractionVisitor):
+
+    def __init__(self, datasets: Mapping[VariableId, xr.Dataset],
+                 extraction_data_list: Sequence[Mapping[Union[Coordinate, TimeResolution], Union[int, float]]],
+                 half_lat_frame: int, half_lon_frame: int, dask_scheduler: str = 'single-threaded'):
+        super().__init__(datasets, extraction_data_list, half_lat_frame, half_lon_frame, dask_scheduler)
+
+    def __extract_regions(self, var: SingleLevelVariable, variable_level: int = None,
+                          level_netcdf_attr_name: str = 'level') -> None:
+        if var.str_id not in self._stacks:
+            selected_regions = SquareRegionExtractionVisitor.select_regions(var, self._datasets[var.str_id],
+                                                                            self._extraction_data_list,
+                                                                            self._half_lat_frame,
+                                                                            self._half_lon_frame, variable_level,
+                                                                            level_netcdf_attr_name)
+            if self._selected_regions is not None:
+                # Computed later, with the other regions of the computed variable.
+                self._selected_regions[var.str_id] = selected_regions
+                return
+            self._selected_regions = {var.str_id: selected_regions}
+            self.__stack_regions()
+        self._result = self._stacks[var.str_id]
+
+    # Compute the selected regions at once then stack them, variable per variable.
+    def __stack_regions(self) -> None:
+        selected_regions = self._selected_regions
+        self._selected_regions = None
+        extracted_regions = xtract.compute_square_regions([region for regions in selected_regions.values()
+                                                           for region in regions], self._dask_scheduler,
+                                                          has_to_compute_dask=False)
+        start = 0
+        for var_id, regions in selected_regions.items():
+            stop = start + len(regions)
+            self._stacks[var_id] = SquareRegionStackExtractionVisitor.__stack(extracted_regions[start:stop])
+            start = stop
+
+    @staticmethod
+    def __stack(regions: Sequence[xr.DataArray]) -> xr.DataArray:
+        first_region = regions[0]
+        dims = (TensorDimension.IMG, *first_region.dims)
+        if first_region.chunks is not None:
+            # The regions of a variable come from the same dataset: they are all backed by dask.
+            return xr.DataArray(da.stack([region.data for region in regions]), dims=dims)
+        stack = np.empty((len(regions), *first_region.shape), dtype=first_region.dtype)
+        for index, region in enumerate(regions):
+            stack[index] = region.values
+        return xr.DataArray(stack, dims=dims)
+
+    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+        self.__extract_regions(var)
+
+    def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
+        self.__extract_regions(var, variable_level=var.level, level_netcdf_attr_name=var.level_netcdf_attr_name)
+
+    def visit_computed_variable(self, var: ComputedVariable) -> None:
+        if self._selected_regions is not None:
+            # Only select the regions of the internal variables (see __stack_regions).
+            for internal_var in var.get_variables().values():
+                internal_var.accept(self)
+            return
+
+        if not self._stacks:
+            # First call on the recursive stack: select then stack the regions of all the variables.
+            self._selected_regions = dict()
+            for internal_var in var.get_variables().values():
+                internal_var.accept(self)
+            self.__stack_regions()
+
+        if var.str_id not in self._stacks:
+            for internal_var in var.get_variables().values():
+                internal_var.accept(self)
+            calculator = XarrayRpnCalculator(var.computation_expression, self._stacks, self._dask_scheduler)
+            # The dask backed stacks are computed once, with the result (see get_result).
+            self._stacks[var.str_id] = calculator.compute(has_to_compute_dask=False)
+        self._result = self._stacks[var.str_id]
+
+    def get_result(self) -> xr.DataArray:
+        self._stacks.clear()
+        if self._result.chunks is not None:
+            # The single dask graph of the selections, the stacks and the computation expressions.
+            self._result = self._result.compute(scheduler=self._dask_scheduler)
+        return self._result
+
+
 def __test_create_extraction_data(lat: float, lon: float, year: int, month: int, day: int, hour: int) \
                              -> Mapping[Union[Coordinate, TimeResolution], Union[int, float]]:
     result = {Coordinate.LAT: lat, Coordinate.LON: lon, TimeResolution.YEAR: year, TimeResolution.MONTH: month,
@@ -206,7 +338,7 @@ def __test_extraction(str_id, variable_parent_dir_path,
                                               dask_scheduler='single-threaded')
     var.accept(extractor)
     extracted_region = extractor.get_result()
-    [dataset.close() for dataset in datasets.values()]
+    [xtract.close_netcdf(dataset) for dataset in datasets.values()]
 
     if has_to_plot:
         plt.figure()
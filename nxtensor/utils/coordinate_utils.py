@@ -19,6 +19,11 @@ def round_nearest(value, resolution, num_decimal):
     return round(round(value / resolution) * resolution, num_decimal)
 
 
+# Vectorized version of round_nearest.
+def round_nearest_array(values: np.ndarray, resolution: float, num_decimal: int) -> np.ndarray:
+    return np.round(np.round(values / resolution) * resolution, num_decimal)
+
+
 def reformat_coordinates(dataframe: pd.DataFrame, column_name: str, from_format: CoordinateFormat,
                          to_format: CoordinateFormat, resolution: float, nb_decimal_to_round: int):
     coordinate_mapping = __get_convert_mapping(from_format, to_format, resolution)
@@ -10,6 +10,14 @@ from typing import Union, Dict, Mapping, Sequence
 
 from nxtensor.utils.csv_option_names import CsvOptName
 
+# Optional dependency: C++ csv writer, much faster than the csv module.
+try:
+    import pyarrow
+    import pyarrow.csv
+    __HAS_PYARROW = True
+except ImportError:
+    __HAS_PYARROW = False
+
 
 def create_csv_options(separator: str = None, header: int = None, line_terminator: str = None, encoding: str = None,
                        quote_char: str = None, quoting: int = None) -> Dict[CsvOptName, Union[str, int]]:
@@ -44,8 +52,15 @@ DEFAULT_CSV_OPTIONS: Mapping[CsvOptName, any] = {CsvOptName.SEPARATOR: ',',
                                                  CsvOptName.ENCODING: 'utf-8'}
 
 
+# use_pyarrow: write with pyarrow when it is installed and the options are supported (see __is_pyarrow_compliant).
+# Opt-in because the files are not the same: pyarrow formats the floats on its own (e.g. 1 instead of 1.0,
+# 0.00001 instead of 1e-05).
 def to_csv(data: Sequence[Mapping[str, any]], file_path: str,
-           csv_options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS) -> None:
+           csv_options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS, use_pyarrow: bool = False) -> None:
+
+    if use_pyarrow and __is_pyarrow_compliant(csv_options):
+        __to_csv_with_pyarrow(data, file_path, csv_options)
+        return
 
     encoding = None
     header = -1
@@ -54,7 +69,7 @@ def to_csv(data: Sequence[Mapping[str, any]], file_path: str,
        CsvOptName.LINE_TERMINATOR in csv_options or\
        CsvOptName.SEPARATOR in csv_options or\
        CsvOptName.HEADER in csv_options:
-        csv_options = {k: v for k, v in csv_options.items()}
+        csv_options = dict(csv_options)
 
         if CsvOptName.ENCODING in csv_options:
             encoding = csv_options.pop(CsvOptName.ENCODING)
@@ -81,3 +96,27 @@ def to_csv(data: Sequence[Mapping[str, any]], file_path: str,
         csv_writer.writerow(mapping)
 
     file.close()
+
+
+__PYARROW_COMPLIANT_OPTIONS = {CsvOptName.SEPARATOR, CsvOptName.HEADER, CsvOptName.LINE_TERMINATOR,
+                               CsvOptName.ENCODING, CsvOptName.QUOTE_CHAR, CsvOptName.QUOTING}
+
+
+# Pyarrow only quotes the strings (like csv.QUOTE_NONNUMERIC) with '"', encodes in utf-8 and terminates
+# the lines with '\n'. Other options fall back on the csv module.
+def __is_pyarrow_compliant(csv_options: Mapping[CsvOptName, any]) -> bool:
+    return __HAS_PYARROW and \
+        csv_options.keys() <= __PYARROW_COMPLIANT_OPTIONS and \
+        csv_options.get(CsvOptName.QUOTING) == csv.QUOTE_NONNUMERIC and \
+        csv_options.get(CsvOptName.QUOTE_CHAR, '"') == '"' and \
+        csv_options.get(CsvOptName.LINE_TERMINATOR) == '\n' and \
+        str(csv_options.get(CsvOptName.ENCODING, 'utf-8')).lower() in ('utf-8', 'utf8')
+
+
+def __to_csv_with_pyarrow(data: Sequence[Mapping[str, any]], file_path: str,
+                          csv_options: Mapping[CsvOptName, any]) -> None:
+    fieldnames = sorted(data[0].keys())
+    table = pyarrow.Table.from_pylist(data).select(fieldnames)
+    write_options = pyarrow.csv.WriteOptions(include_header=csv_options.get(CsvOptName.HEADER, -1) >= 0,
+                                             delimiter=csv_options.get(CsvOptName.SEPARATOR, ','))
+    pyarrow.csv.write_csv(table, file_path, write_options=write_options)
@@ -15,16 +15,20 @@ from nxtensor.utils.csv_utils import DEFAULT_CSV_OPTIONS
 from nxtensor.utils.db_types import DBType
 from nxtensor.utils.time_resolutions import TimeResolution
 
+# Number of rows written at once by pandas.to_csv.
+PANDAS_CSV_CHUNK_SIZE: int = 65536
+
 
 def save_to_csv_file(data: pd.DataFrame, csv_file_path: str, options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS):
     try:
         # Line terminator parameter name is not compatible with pandas.to_csv.
-        options = {k: v for k, v in options.items()}
-        line_terminator = options[CsvOptName.LINE_TERMINATOR]
-        del options[CsvOptName.LINE_TERMINATOR]
-        options['line_terminator'] = line_terminator
+        # Copy the options only when they have to be modified.
+        if CsvOptName.LINE_TERMINATOR in options:
+            options = dict(options)
+            options['line_terminator'] = options.pop(CsvOptName.LINE_TERMINATOR)
 
-        data.to_csv(path_or_buf=csv_file_path, **options)
+        # Write by large chunks.
+        data.to_csv(path_or_buf=csv_file_path, **{'chunksize': PANDAS_CSV_CHUNK_SIZE, **options})
     except Exception as e:
         msg = f"error while saving cvs file '{csv_file_path}' with options {options}"
         raise Exception(msg, e)
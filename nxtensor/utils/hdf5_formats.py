@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+class HDF5Format:
+
+    RAW        = 'raw'         # h5py dataset.
+    COMPRESSED = 'compressed'  # h5py chunked dataset compressed with blosc:zstd (fall back on RAW).
+    TABLE      = 'table'       # Pandas (PyTables) table format, one row per image.
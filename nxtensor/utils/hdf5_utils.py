@@ -1,7 +1,22 @@
 
 
+from typing import Tuple, Callable, Mapping
+
 import h5py
 import numpy as np
+import pandas as pd
+
+from nxtensor.utils.hdf5_formats import HDF5Format
+
+# Optional dependency: registers the BLOSC filter (id 32001) into h5py.
+try:
+    import hdf5plugin
+    __HAS_BLOSC = True
+except ImportError:
+    __HAS_BLOSC = False
+
+# Target size of a chunk of a compressed dataset (1 MiB).
+COMPRESSED_CHUNK_BYTE_SIZE: int = 1024 * 1024
 
 
 def write_ndarray_to_hdf5(file_path: str, ndarray: np.ndarray) -> None:
@@ -10,7 +25,61 @@ def write_ndarray_to_hdf5(file_path: str, ndarray: np.ndarray) -> None:
     hdf5_file.close()
 
 
+# Write the given ndarray in a chunked dataset, compressed with blosc:zstd.
+# Fall back on write_ndarray_to_hdf5 when hdf5plugin is not installed.
+def write_compressed_ndarray_to_hdf5(file_path: str, ndarray: np.ndarray) -> None:
+    if not __HAS_BLOSC or ndarray.ndim == 0 or ndarray.size == 0:
+        write_ndarray_to_hdf5(file_path, ndarray)
+        return
+    compression_options = hdf5plugin.Blosc(cname='zstd', clevel=9, shuffle=hdf5plugin.Blosc.SHUFFLE)
+    with h5py.File(file_path, 'w') as hdf5_file:
+        hdf5_file.create_dataset('dataset', data=ndarray, chunks=__compute_chunk_shape(ndarray),
+                                 **compression_options)
+
+
+# Chunk along the first dimension (the images) so as a chunk weighs about COMPRESSED_CHUNK_BYTE_SIZE.
+def __compute_chunk_shape(ndarray: np.ndarray) -> Tuple[int, ...]:
+    item_byte_size = int(ndarray[0].nbytes) if ndarray.ndim > 1 else ndarray.itemsize
+    nb_items = max(1, min(ndarray.shape[0], COMPRESSED_CHUNK_BYTE_SIZE // max(1, item_byte_size)))
+    return (nb_items, *ndarray.shape[1:])
+
+
+# Read the ndarray written in any of the HDF5Format formats: the format is detected from the file.
 def read_ndarray_from_hdf5(file_path: str) -> np.ndarray:
     hdf5_file = h5py.File(file_path, 'r')
     data = hdf5_file.get('dataset')
+    if isinstance(data, h5py.Group):
+        # A pandas table is a group, not a dataset (see write_ndarray_to_hdf5_table).
+        hdf5_file.close()
+        return read_ndarray_from_hdf5_table(file_path)
     return np.array(data)
+
+
+# Write the given ndarray as a pandas table (requires PyTables): one row per image (the other dimensions
+# are flattened), compressed with blosc:zstd. Read with read_ndarray_from_hdf5 or read_ndarray_from_hdf5_table.
+def write_ndarray_to_hdf5_table(file_path: str, ndarray: np.ndarray) -> None:
+    dataframe = pd.DataFrame(ndarray.reshape(ndarray.shape[0], -1))
+    dataframe.columns = dataframe.columns.astype(str)
+    with pd.HDFStore(file_path, mode='w', complib='blosc:zstd', complevel=5) as store:
+        store.put('dataset', dataframe, format='table')
+        store.get_storer('dataset').attrs.ndarray_shape = ndarray.shape
+
+
+def read_ndarray_from_hdf5_table(file_path: str) -> np.ndarray:
+    with pd.HDFStore(file_path, mode='r') as store:
+        shape = store.get_storer('dataset').attrs.ndarray_shape
+        return store.get('dataset').to_numpy().reshape(shape)
+
+
+def get_ndarray_write_function(hdf5_format: HDF5Format) -> Callable[[str, np.ndarray], None]:
+    try:
+        return __WRITE_FORMAT_FUNCTIONS[hdf5_format]
+    except KeyError:
+        msg = f"unsupported hdf5 format '{hdf5_format}'"
+        raise Exception(msg)
+
+
+__WRITE_FORMAT_FUNCTIONS: Mapping[HDF5Format, Callable[[str, np.ndarray], None]] =\
+    {HDF5Format.RAW: write_ndarray_to_hdf5,
+     HDF5Format.COMPRESSED: write_compressed_ndarray_to_hdf5,
+     HDF5Format.TABLE: write_ndarray_to_hdf5_table}
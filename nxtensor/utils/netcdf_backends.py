@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+class NetcdfBackend:
+
+    XARRAY  = 'xarray'   # xarray datasets: lazy selections, computed at once (dask or not).
+    NETCDF4 = 'netcdf4'  # netCDF4 datasets: the regions are read directly (no xarray indexing).
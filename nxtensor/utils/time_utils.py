@@ -7,11 +7,15 @@ Created on Thu Mar 28 12:04:09 2019
 """
 
 import datetime
+import functools
 import logging
-from typing import Dict, Sequence, Union, Mapping, Iterable, List
+import string
+from typing import Dict, Sequence, Union, Mapping, Iterable, List, Optional, Tuple
+
+import numpy as np
 
 import nxtensor.utils.naming_utils
-from nxtensor.core.types import Period
+from nxtensor.core.types import Period, PeriodCode
 from nxtensor.utils.time_resolutions import TimeResolution
 
 
@@ -20,6 +24,49 @@ def sort_periods(periods: Iterable[Period]) -> Sequence[Period]:
     return sorted(periods)
 
 
+# Number of bits of the time values of a period, following the order of TimeResolution::TIME_RESOLUTION_KEYS
+# (month, day, hour, minute, second, millisecond, microsecond). The year is not bounded.
+__PERIOD_NB_BITS = (4, 5, 5, 6, 6, 10, 20)
+
+
+# Pack the given period into an integer, faster to hash and to compare than a tuple.
+# The codes of periods of the same length are sorted as the periods.
+def pack_period(period: Period) -> PeriodCode:
+    result: PeriodCode = int(period[0])
+    for value, nb_bits in zip(period[1:], __PERIOD_NB_BITS):
+        result = (result << nb_bits) | int(value)
+    return result
+
+
+# Format the given date template (e.g. '{year}-{month2d}-{day}T{hour2d}', see str.format) with each of the given
+# time dictionaries, at once: the fields are gathered and concatenated column by column (numpy), instead of
+# formatting the dictionaries one by one. Fall back on str.format for the templates with format specifications or
+# conversions.
+def format_dates(date_template: str, time_dicts: Sequence[Mapping[str, any]]) -> List[str]:
+    template_parts = __parse_date_template(date_template)
+    if template_parts is None:
+        return [date_template.format(**time_dict) for time_dict in time_dicts]
+    result = np.full(len(time_dicts), '', dtype=object)
+    for literal, field_name in template_parts:
+        if literal:
+            result = result + literal
+        if field_name is not None:
+            result = result + np.array([str(time_dict[field_name]) for time_dict in time_dicts], dtype=object)
+    return result.tolist()
+
+
+# Return the literals and the field names of the given date template, None if the template has format
+# specifications or conversions.
+@functools.lru_cache(maxsize=None)
+def __parse_date_template(date_template: str) -> Optional[Tuple[Tuple[str, Optional[str]], ...]]:
+    result = list()
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(date_template):
+        if format_spec or conversion:
+            return None
+        result.append((literal, field_name))
+    return tuple(result)
+
+
 def create_period(period_str: str) -> Period:
     splits: List[str] = period_str.split(nxtensor.utils.naming_utils.NAME_SEPARATOR)
     try:
@@ -106,3 +153,24 @@ def display_duration(time_in_sec):
                 days = int(hours / 24)
                 hours = remainder
                 return f'{days} days, {hours} hours, {minutes} mins, {seconds:.2f} seconds'
+
+
+# The period codes must be distinct and sorted as the periods (tuples) they replace as keys.
+def __test_pack_period():
+    rng = np.random.default_rng(0)
+    for period_length in range(1, 5):
+        periods = {tuple([int(rng.integers(1979, 2100))] +
+                         [int(rng.integers(bounds[0], bounds[1])) for bounds in ((1, 13), (1, 32), (0, 24))]
+                         [:period_length - 1])
+                   for _ in range(1000)}
+        codes = {pack_period(period): period for period in periods}
+        assert len(codes) == len(periods)
+        assert [codes[code] for code in sorted(codes.keys())] == sort_periods(periods)
+
+
+def __all_tests():
+    __test_pack_period()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -6,9 +6,10 @@ Created on Fri Mar 29 15:29:43 2019
 @author: sebastien@gardoll.fr
 """
 
+import contextlib
 import re
 import logging
-from typing import Mapping
+from typing import ContextManager, Mapping
 
 import dask
 import numpy as np
@@ -19,27 +20,29 @@ import xarray as xr
 from nxtensor.core.types import VariableId
 
 
+# The operations on dask backed DataArray are lazy: they build a single dask graph (with the graph of the operands)
+# which is computed once, when the result of the expression is known (see compute).
 class XarrayRpnCalculator:
 
     @staticmethod
     # Return left_operand + right_operand
     def __addition(left_operand, right_operand):
-        return (left_operand + right_operand).compute()
+        return left_operand + right_operand
 
     @staticmethod
     # Return left_operand - right_operand
     def __subtraction(left_operand, right_operand):
-        return (left_operand - right_operand).compute()
+        return left_operand - right_operand
 
     @staticmethod
     # Return left_operand *
     def __multiplication(left_operand, right_operand):
-        return (left_operand * right_operand).compute()
+        return left_operand * right_operand
 
     @staticmethod
     # Return left_operand / right_operand
     def __division(left_operand, right_operand):
-        return (left_operand / right_operand).compute()
+        return left_operand / right_operand
 
     @staticmethod
     # Return the square root of the operand (√x)
@@ -175,7 +178,9 @@ class XarrayRpnCalculator:
         self.__stack.append(label)
         self.__intermediate_results[label] = intermediate_result
 
-    def compute(self):
+    # has_to_compute_dask: when false, the result of dask backed operands is returned uncomputed, so as the caller
+    # computes it within a larger graph.
+    def compute(self, has_to_compute_dask: bool = True):
         tokens = XarrayRpnCalculator.TOKENIZER.split(self.__expression)
         tokens = self.__check_tokens(tokens)
         logging.debug(f"computing tokens: {tokens}")
@@ -183,6 +188,17 @@ class XarrayRpnCalculator:
             logging.debug(f"appending token '{token}' on the stack")
             self.__stack.append(token)
             if token in XarrayRpnCalculator.OPERATORS:
-                with dask.config.set(scheduler=self.__dask_scheduler):
-                    self.__compute()
-        return self.get_result()
+                self.__compute()
+        result = self.get_result()
+        if has_to_compute_dask and result.chunks is not None:
+            # The scheduler is set once for the whole graph.
+            with self.__set_dask_scheduler():
+                self.__result = result.compute()
+        return self.__result
+
+    # The dask configuration is only modified when the scheduler is not already the one of the configuration.
+    def __set_dask_scheduler(self) -> ContextManager:
+        if dask.config.get('scheduler', None) == self.__dask_scheduler:
+            return contextlib.nullcontext()
+        else:
+            return dask.config.set(scheduler=self.__dask_scheduler)
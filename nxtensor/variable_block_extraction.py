@@ -11,9 +11,12 @@ from typing import Dict, Tuple, List
 
 from nxtensor.extraction import ExtractionConfig
 from nxtensor.extractor import ExtractionVisitor
+from nxtensor.utils.hdf5_formats import HDF5Format
+from nxtensor.utils.netcdf_backends import NetcdfBackend
 from nxtensor.variable import Variable
 
 import nxtensor.core.xarray_channel_extraction as chan_xtract
+import nxtensor.core.xarray_extractions as xtract
 from nxtensor.core.types import LabelId, MetaDataBlock, Period, DBMetadataMapping
 
 import pandas as pd
@@ -65,9 +68,15 @@ class __SquareExtractionProcessor(chan_xtract.BlockProcessor):
     def __init__(self, extraction_conf: ExtractionConfig, variable: Variable):
         self.__extraction_conf = extraction_conf
         self.__variable = variable
+        # Not set in the configurations saved before the option.
+        self.__netcdf_cache_size = getattr(extraction_conf, 'netcdf_cache_size', None)
 
     def process_blocks(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]]) \
             -> Tuple[str, List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]]:
+        # Set in the process that extracts the blocks: the worker processes that are not forked (see
+        # xarray_channel_extraction.extract) import xarray_extractions with the default cache size.
+        if self.__netcdf_cache_size is not None and xtract.NETCDF_CACHE_SIZE != self.__netcdf_cache_size:
+            xtract.configure_netcdf_cache(self.__netcdf_cache_size)
         # Must be a integer !!! TODO: check for that when designing an extraction.
         half_lat_frame = int((self.__extraction_conf.y_size * self.__variable.lat_resolution)/2)
         half_lon_frame = int((self.__extraction_conf.y_size * self.__variable.lon_resolution)/2)
@@ -77,7 +86,12 @@ class __SquareExtractionProcessor(chan_xtract.BlockProcessor):
                                                          half_lat_frame=half_lat_frame,
                                                          half_lon_frame=half_lon_frame,
                                                          dask_scheduler=self.__extraction_conf.dask_scheduler,
-                                                         shape=self.__extraction_conf.extraction_shape)
+                                                         shape=self.__extraction_conf.extraction_shape,
+                                                         # Not set in the configurations saved before the options.
+                                                         netcdf_backend=getattr(self.__extraction_conf,
+                                                                                'netcdf_backend',
+                                                                                NetcdfBackend.XARRAY),
+                                                         dtype=getattr(self.__extraction_conf, 'region_dtype', None))
         self.__variable.accept(extractor)
         result: Tuple[str, List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]] = \
             (self.__extraction_conf.blocks_dir_path, extractor.get_result())
@@ -94,7 +108,12 @@ def extract(extraction_conf_file_path: str, variable_id: str) -> Dict[Period, Di
     file_paths = chan_xtract.extract(variable_id=variable_id,
                                      preprocess_input_file_path=preprocess_input_file_path,
                                      block_processor=block_processor,
-                                     nb_workers=extraction_conf.nb_process)
+                                     nb_workers=extraction_conf.nb_process,
+                                     # Not set in the configurations saved before the option.
+                                     data_block_hdf5_format=getattr(extraction_conf, 'data_block_hdf5_format',
+                                                                    HDF5Format.COMPRESSED),
+                                     use_pyarrow_csv_writer=getattr(extraction_conf, 'use_pyarrow_csv_writer',
+                                                                    False))
     return file_paths
 
 
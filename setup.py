@@ -25,6 +25,7 @@ setuptools.setup(
     ],
     python_requires='>=3.7',
     install_requires=[
+        'cftime>=1.2.0',
         'dask>=2.17.2',
         'h5py>=2.10.0',
         'netcdf4>=1.5.3',
@@ -32,6 +33,11 @@ setuptools.setup(
         'pandas>=1.0.3',
         'pyyaml>=5.3.1',
         'scikit-learn>=0.22.1',
-        'xarray>=0.15.1'
+        'xarray>=0.17.0'
     ],
+    extras_require={
+        'blosc': ['hdf5plugin>=2.3.0'],  # BLOSC compression of the data blocks.
+        'pyarrow': ['pyarrow>=7.0.0'],  # Fast writing of the metadata blocks.
+        'table': ['tables>=3.6.1']  # Data blocks in pandas table format.
+    },
 )